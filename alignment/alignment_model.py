@@ -7,6 +7,7 @@ In this file are defined all aligners and the DeepJSCC class that uses the align
 
 import torch.nn as nn
 from channel import Channel
+from tiling import tiled_forward
 import torch
 
 def a_inv_times_b(a, b):
@@ -62,6 +63,40 @@ class _LinearAlignment(nn.Module):
         return x.reshape(shape)
 
 
+class _LowRankLinearAlignment(nn.Module):
+    """
+    Aligner class that uses a rank r factorization left @ right.T of the
+    linear layer, 2 * size * rank parameters instead of size ** 2.
+
+    Used both for truncated least squares and Adam optimization forms.
+    """
+
+    def __init__(self, size=None, rank=None, left=None, right=None):
+        super(_LowRankLinearAlignment, self).__init__()
+
+        if left is not None:
+            self.left = nn.Parameter(left, requires_grad=False)
+            self.right = nn.Parameter(right, requires_grad=False)
+
+        else:
+            # entries of the product have variance 1 / size, as the xavier dense matrix
+            self.left = nn.Parameter(torch.randn(size, rank) * (size * rank) ** -0.25)
+            self.right = nn.Parameter(torch.randn(size, rank) * (size * rank) ** -0.25)
+
+    def forward(self, x):
+        # get shape of input
+        shape = x.shape
+
+        # flatten input
+        x = x.flatten(start_dim=1)
+
+        # apply alignment through the rank r bottleneck
+        x = (x @ self.left) @ self.right.T
+
+        # return to original shape
+        return x.reshape(shape)
+
+
 class _MLPAlignment(nn.Module):
     """
     Aligner class that uses a Multi-Layer Perceptron (MLP).
@@ -204,22 +239,48 @@ class AlignedDeepJSCC(nn.Module):
         self.decoder = decoder
         self.decoder.requires_grad = False
 
-        # get forward function
-        if type(self.aligner) == _ZeroShotAlignment:
-            self.forward = self._forward_zeroshot
-        
-        else:
-            self.forward = self._forward_default
+        # zeroshot aligner needs its own forward function, chosen in forward
+        # rather than by rebinding self.forward so the module can be scripted
+        self.zeroshot = type(self.aligner) == _ZeroShotAlignment
+
+    def forward(self, x, generator=None):
+        if self.zeroshot:
+            return self._forward_zeroshot(x, generator)
+
+        return self._forward_default(x, generator)
 
-    def _forward_default(self, x):
+    def _forward_default(self, x, generator=None):
         """
         Forward function for most aligners.
         """
 
         z = self.encoder(x)
 
+        return self._forward_latent_default(z, generator)
+
+    def _forward_zeroshot(self, x, generator=None):
+        """
+        Forward function for zeroshot aligner.
+        """
+
+        z = self.encoder(x)
+
+        return self._forward_latent_zeroshot(z, generator)
+
+    def forward_latent(self, z, generator=None):
+        """
+        Forward function starting from encoder outputs, skips the encoder.
+        """
+
+        if self.zeroshot:
+            return self._forward_latent_zeroshot(z, generator)
+
+        return self._forward_latent_default(z, generator)
+
+    def _forward_latent_default(self, z, generator=None):
+        # encoder outputs have the power set by its normalization layer
         if self.channel is not None:
-            z = self.channel(z)
+            z = self.channel(z, generator, sig_pwr=self.encoder.norm.P)
 
         if self.aligner is not None:
             z = self.aligner(z)
@@ -228,13 +289,7 @@ class AlignedDeepJSCC(nn.Module):
 
         return x_hat
 
-    def _forward_zeroshot(self, x):
-        """
-        Forward function for zeroshot aligner.
-        """
-
-        z = self.encoder(x)
-
+    def _forward_latent_zeroshot(self, z, generator=None):
         # get shape of input
         shape = z.shape
 
@@ -248,7 +303,7 @@ class AlignedDeepJSCC(nn.Module):
         z = self.aligner.compression(z)
 
         if self.channel is not None:
-            z = self.channel(z)
+            z = self.channel(z, generator)
 
         # zeroshot decompression
         z = self.aligner.decompression(z)
@@ -259,6 +314,16 @@ class AlignedDeepJSCC(nn.Module):
 
         return x_hat
 
+    def forward_tiled(self, x, tile_size=256, overlap=32, memory_budget=256 * 2**20, num_workers=1, seed=None):
+        """
+        Forward function for large images, processed by overlapping tiles.
+
+        See tiling.tiled_forward, aligners that act on the flattened latent
+        need tiles of the size they were trained on.
+        """
+
+        return tiled_forward(self, x, tile_size, overlap, memory_budget, num_workers, seed)
+
     def change_channel(self, channel_type='AWGN', snr=None):
         if snr is None:
             self.channel = None
@@ -8,12 +8,11 @@ In this file are defined functions and classes for training of aligners.
 import torch
 import torch.nn as nn
 import torch.optim as optim
-import copy
 import numpy as np
 import random
 
 from torch.utils.data import Dataset, DataLoader
-from alignment.alignment_model import _ConvolutionalAlignment, _TwoConvAlignment, _LinearAlignment, _ZeroShotAlignment, _MLPAlignment
+from alignment.alignment_model import _ConvolutionalAlignment, _TwoConvAlignment, _LinearAlignment, _ZeroShotAlignment, _MLPAlignment, _LowRankLinearAlignment
 
 from model import DeepJSCC
 from tqdm import tqdm
@@ -22,42 +21,47 @@ from channel import Channel
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from torchvision import datasets
-from dataset import Vanilla
+from dataset import Vanilla, cache_transform, cache_path, cached, collate_cached
 
-def get_data_loaders(dataset, resolution, batch_size, num_workers):
-    if dataset == 'cifar10':
+def get_data_loaders(dataset, resolution, batch_size, num_workers, cache_dir=None):
+    """
+    Train and test loaders of dataset at the given resolution. With a
+    cache_dir the images are served from uint8 caches, built on first use.
+    """
+    if cache_dir is not None:
+        transform = cache_transform(resolution)
+    else:
         transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((resolution, resolution))])
 
+    if dataset == 'cifar10':
         train_dataset = datasets.CIFAR10(root='../dataset/', train=True, download=True, transform=transform)
-        train_loader = DataLoader(train_dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-
         test_dataset = datasets.CIFAR10(root='../dataset/', train=False, download=True, transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=False, batch_size=batch_size, num_workers=num_workers)
 
     elif dataset == 'imagenet':
         # the size of paper is 128
-        transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((resolution, resolution))])
-
         print("loading data of imagenet")
 
         train_dataset = datasets.ImageFolder(root='./dataset/ImageNet/train', transform=transform)
-        train_loader = DataLoader(train_dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-
         test_dataset = Vanilla(root='./dataset/ImageNet/val', transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=False, batch_size=batch_size, num_workers=num_workers)
 
     elif dataset == 'imagenette':
-        transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((resolution, resolution))])
-
         train_dataset = datasets.Imagenette(root='../dataset/', split="train", download=True, transform=transform)
-        train_loader = DataLoader(train_dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-
         test_dataset = datasets.Imagenette(root='../dataset/', split="val", download=True, transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=False, batch_size=batch_size, num_workers=num_workers)
 
     else:
         raise Exception('Unknown dataset')
-    
+
+    collate_fn = None
+    if cache_dir is not None:
+        train_dataset = cached(train_dataset, cache_path(cache_dir, dataset, 'train', resolution), num_workers)
+        test_dataset = cached(test_dataset, cache_path(cache_dir, dataset, 'val', resolution), num_workers)
+        collate_fn = collate_cached
+
+    train_loader = DataLoader(train_dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers,
+                              collate_fn=collate_fn)
+    test_loader = DataLoader(test_dataset, shuffle=False, batch_size=batch_size, num_workers=num_workers,
+                             collate_fn=collate_fn)
+
     return train_loader, test_loader
 
 
@@ -164,366 +168,393 @@ def dataset_to_matrices(dataset, batch_size=128):
     return torch.cat(data_1, dim=0), torch.cat(data_2, dim=0)
 
 
-def train_linear_aligner(data, permutation, n_samples, train_snr):
+def _hermitian_solve(a, b):
     """
-    Solve least squares problem with regularization.
+    a^-1 b for a hermitian positive definite a, by Cholesky.
     """
 
-    # prepare data
-    indices = permutation[:n_samples]
-    subset = AlignmentSubset(data, indices)
-    matrix_1, matrix_2 = dataset_to_matrices(subset)
+    L, info = torch.linalg.cholesky_ex(a)
+    if info.item() == 0:
+        return torch.cholesky_solve(b, L)
 
-    X = matrix_1.H
-    Y = matrix_2.H
+    # not numerically positive definite, fall back to a general solve
+    return torch.linalg.solve(a, b)
 
-    # noise handling with regularization
-    snr_linear = 10 ** (train_snr / 10)
-    sigma2 = 1.0 / snr_linear # noise variance
-    noise_cov = sigma2 * torch.eye(X.shape[0], device=X.device, dtype=X.dtype)
 
-    regularization = 1000 * 10 ** (-train_snr / 30)
-    reg_matrix = regularization * torch.eye(X.shape[0], device=X.device, dtype=X.dtype)
+def noise_variance(train_snr):
+    snr_linear = 10 ** (train_snr / 10)
+    return 1.0 / snr_linear
 
-    F = Y @ X.H @ torch.linalg.inv(X @ X.H + noise_cov + reg_matrix)
 
-    return _LinearAlignment(align_matrix=F.T).cpu()
+def default_regularization(train_snr):
+    """
+    Regularization of the least squares aligner at train_snr, on top of the noise variance.
+    """
+    return 1000 * 10 ** (-train_snr / 30)
 
 
-def train_neural_aligner(data, permutation, n_samples, batch_size, resolution, ratio, train_snr, device):
+class NormalEquations:
     """
-    Train convolutional aligner with Adam optimization using train/validation split.
+    Least squares aligner over the first n_samples pilots of a permutation.
+
+    While there are fewer pilots than latent dimensions d the pilots are
+    kept and the aligner is solved in the dual form, an n x n system.
+    Past d only the running sums X X^H and X Y^H are kept and the d x d
+    primal system is solved. Extending to more pilots only reads the new
+    ones, so a sweep over increasing pilot counts reads every pilot once.
+    The form used by the last solve is in self.path.
     """
 
-    # train settings
-    epochs_max=10000
-    patience=20
-    min_delta=1e-5
-
-    # prepare data with train/validation split
-    indices = permutation[:n_samples]
-    
-    # handle small datasets (< 10 samples)
-    if n_samples < 10:
-        use_val = False
+    def __init__(self, data, permutation, batch_size=128):
+        self.data = data
+        self.permutation = permutation
+        self.batch_size = batch_size
+        self.n_samples = 0
+        self.matrix_1 = None
+        self.matrix_2 = None
+        self.xx = None
+        self.xy = None
+        self.yy = 0.0
+        self.path = None
+
+    def extend(self, n_samples):
+        if n_samples < self.n_samples:
+            raise Exception('Pilots of a sweep must be in increasing order')
+        if n_samples == self.n_samples:
+            return
+
+        subset = AlignmentSubset(self.data, self.permutation[self.n_samples:n_samples])
+        matrix_1, matrix_2 = dataset_to_matrices(subset, self.batch_size)
+        self.n_samples = n_samples
+        # squared norm of the targets, for the residuals of the ridge path
+        self.yy += matrix_2.abs().pow(2).sum().item()
+
+        if self.xx is not None:
+            self.xx += matrix_1.H @ matrix_1
+            self.xy += matrix_1.H @ matrix_2
+            return
+
+        if self.matrix_1 is not None:
+            matrix_1 = torch.cat([self.matrix_1, matrix_1])
+            matrix_2 = torch.cat([self.matrix_2, matrix_2])
+
+        if n_samples <= matrix_1.shape[1]:
+            self.matrix_1, self.matrix_2 = matrix_1, matrix_2
+        else:
+            # more pilots than dimensions, the primal form is cheaper from now on
+            self.xx = matrix_1.H @ matrix_1
+            self.xy = matrix_1.H @ matrix_2
+            self.matrix_1, self.matrix_2 = None, None
+
+    def product(self, train_snr, regularization=None):
+        """
+        (P, Q) with P @ Q the aligner matrix F.T, Q is None in the primal
+        form where P is the matrix itself. In the dual form P and Q have
+        rank at most n_samples and F.T is never formed.
+        """
+
+        if self.xx is not None:
+            return self.solve(train_snr, regularization).T, None
+
+        if regularization is None:
+            regularization = default_regularization(train_snr)
+        X = self.matrix_1
+        eye = torch.eye(X.shape[0], device=X.device, dtype=X.dtype)
+        Q = _hermitian_solve(X @ X.H + (noise_variance(train_snr) + regularization) * eye, self.matrix_2)
+        self.path = 'dual'
+
+        # F^H = X^H Q, so F.T is its conjugate
+        return X.H.conj(), Q.conj()
+
+    def solve(self, train_snr, regularization=None):
+        """
+        F = Y X^H (X X^H + noise_cov + reg)^-1, or in the dual form
+        F = Y (X^H X + noise_cov + reg)^-1 X^H, which is the same matrix.
+        """
+
+        # noise handling with regularization
+        sigma2 = noise_variance(train_snr)
+        if regularization is None:
+            regularization = default_regularization(train_snr)
+
+        if self.xx is None:
+            self.path = 'dual'
+            X = self.matrix_1
+            eye = torch.eye(X.shape[0], device=X.device, dtype=X.dtype)
+            # F^H = X (X^H X + c I)^-1 Y^H, with X and Y as d x n pilot matrices
+            return (X.H @ _hermitian_solve(X @ X.H + (sigma2 + regularization) * eye, self.matrix_2)).H
+
+        self.path = 'primal'
+        eye = torch.eye(self.xx.shape[0], device=self.xx.device, dtype=self.xx.dtype)
+        # the system is hermitian, so F^H = (X X^H + c I)^-1 X Y^H
+        return _hermitian_solve(self.xx + (sigma2 + regularization) * eye, self.xy).H
+
+
+class RidgePath:
+    """
+    Least squares aligners of one set of pilots for any regularization and
+    train snr, from a single eigendecomposition.
 
-        # use all data for training, no validation split
-        train_indices = indices
-        val_indices = []
+    With G = X X^H = V S V^H (or X^H X in the dual form) the aligner at a
+    total regularization c is F = Y X^H V (S + c I)^-1 V^H, one product of
+    two matrices, and its generalized cross-validation score
+    n * RSS / (n - tr(H))^2 only needs the eigenvalues.
+    """
 
-    else:
-        use_val = True
-
-        # split into 90 train - 10 validation
-        val_size = max(1, int(0.1 * n_samples))
-        train_size = n_samples - val_size
-        
-        train_indices = indices[:train_size]
-        val_indices = indices[train_size:]
-    
-    # create datasets and dataloaders
-    train_subset = AlignmentSubset(data, train_indices)
-    train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=True)
-    
-    if use_val:
-        val_subset = AlignmentSubset(data, val_indices)
-        val_dataloader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
+    def __init__(self, equations):
+        self.n_samples = equations.n_samples
+        self.yy = equations.yy
+
+        if equations.xx is None:
+            # dual form: X^H X = W S W^H, F = (Y W) (S + c I)^-1 (X W)^H
+            self.path = 'dual'
+            X, Y = equations.matrix_1, equations.matrix_2
+            s, W = torch.linalg.eigh(X @ X.H)
+            self.left = Y.H @ W
+            self.right = X.H @ W
+        else:
+            # primal form: X X^H = V S V^H, F = (Y X^H V) (S + c I)^-1 V^H
+            self.path = 'primal'
+            s, V = torch.linalg.eigh(equations.xx)
+            self.left = equations.xy.H @ V
+            self.right = V
+
+        self.s = s.clamp(min=0)
+        # squared norms of the columns of left, the weights of the residuals
+        self.weights = self.left.abs().pow(2).sum(dim=0)
+
+    def _total(self, regularization, train_snr):
+        if regularization is None:
+            regularization = default_regularization(train_snr)
+        return noise_variance(train_snr) + regularization
+
+    def aligner(self, train_snr, regularization=None):
+        c = self._total(regularization, train_snr)
+        F = (self.left / (self.s + c)) @ self.right.H
+
+        return _LinearAlignment(align_matrix=F.T).cpu()
+
+    def gcv(self, train_snr, regularization=None):
+        """
+        Generalized cross-validation score of the aligner, lower is better.
+        """
+        c = self._total(regularization, train_snr)
+        d = 1 / (self.s + c)
+        if self.path == 'dual':
+            # the residual of component i is scaled by c / (s_i + c)
+            rss = (((c * d) ** 2) * self.weights).sum().item()
+        else:
+            rss = self.yy - ((2 * d - d ** 2 * self.s) * self.weights).sum().item()
+        dof = (self.s * d).sum().item()
 
-    # prepare model and optimizer
-    aligner = _LinearAlignment(size=resolution * resolution * 3 * 2 // ratio).to(device)
-    channel = Channel("AWGN", train_snr)
-    criterion = nn.MSELoss(reduction='mean')
-    optimizer = optim.Adam(aligner.parameters(), lr=1e-4)
+        return self.n_samples * max(rss, 0.0) / max(self.n_samples - dof, 1e-12) ** 2
 
-    # init train state
-    best_loss = float('inf')
-    best_model_state = None
-    checks_without_improvement = 0
-    epoch = 0
+    def gcv_grid(self, train_snrs, regularizations):
+        """
+        GCV scores of every (train snr, regularization) pair, as an array of
+        shape (len(train_snrs), len(regularizations)).
+        """
+        return np.array([[self.gcv(train_snr, regularization) for regularization in regularizations]
+                         for train_snr in train_snrs])
 
-    # train loop
-    while True:
-        # training phase
-        aligner.train()
-        train_loss = 0.0
+    def best_regularization(self, train_snr, regularizations):
+        scores = [self.gcv(train_snr, regularization) for regularization in regularizations]
+        return regularizations[int(np.argmin(scores))]
 
-        for inputs, targets in train_dataloader:
-            if train_snr is not None:
-                inputs = channel(inputs)
 
-            optimizer.zero_grad()
-            outputs = aligner(inputs.to(device))
-            loss = criterion(outputs, targets.to(device))
-            loss = loss * inputs.shape[0]
-            loss.backward()
-            optimizer.step()
-            train_loss += loss.item()
+def linear_aligner_ridge_path(data, permutation, n_samples):
+    """
+    RidgePath of the first n_samples pilots of permutation.
+    """
 
-        # validation phase
-        if use_val:
-            aligner.eval()
-            val_loss = 0.0
-            
-            with torch.no_grad():
-                for inputs, targets in val_dataloader:
-                    if train_snr is not None:
-                        inputs = channel(inputs)
-                    
-                    outputs = aligner(inputs.to(device))
-                    loss = criterion(outputs, targets.to(device))
-                    loss = loss * inputs.shape[0]
-                    val_loss += loss.item()
-            
-            # use validation loss for early stopping
-            avg_val_loss = val_loss / len(val_dataloader)
-            current_loss = avg_val_loss
-        else:
-            # use training loss if no validation set
-            avg_train_loss = train_loss / len(train_dataloader)
-            current_loss = avg_train_loss
+    equations = NormalEquations(data, permutation)
+    equations.extend(n_samples)
 
-        epoch += 1
+    return RidgePath(equations)
 
-        # check if improvement
-        if best_loss - current_loss > min_delta:
-            best_loss = current_loss
-            best_model_state = copy.deepcopy(aligner.state_dict())
-            checks_without_improvement = 0
-        else:
-            checks_without_improvement += 1
 
-        # break if patience exceeded
-        if checks_without_improvement >= patience:
-            break
+def svd_factors(P, Q=None):
+    """
+    (left, right) with left @ right.T = P @ Q (P when Q is None) and the
+    columns sorted by singular value, so left[:, :r] @ right[:, :r].T is
+    the best rank r approximation.
+    """
 
-        # break if max epochs exceeded
-        if epoch > epochs_max:
-            break
+    if Q is None:
+        U, S, Vh = torch.linalg.svd(P, full_matrices=False)
+    else:
+        # P @ Q = Q1 (R1 R2^T) Q2^T, only the small middle matrix is decomposed
+        Q1, R1 = torch.linalg.qr(P)
+        Q2, R2 = torch.linalg.qr(Q.T)
+        u, S, vh = torch.linalg.svd(R1 @ R2.T)
+        U, Vh = Q1 @ u, vh @ Q2.T
 
-    # restore best model
-    if best_model_state is not None:
-        aligner.load_state_dict(best_model_state)
-    
-    return aligner.cpu(), epoch
+    return U * S, Vh.T
 
 
-def train_mlp_aligner(data, permutation, n_samples, batch_size, resolution, ratio, train_snr, device):
+def train_linear_aligner(data, permutation, n_samples, train_snr, verbose=False, rank=None):
     """
-    Train convolutional aligner with Adam optimization using train/validation split.
+    Solve least squares problem with regularization.
+
+    The dual form is used when there are fewer pilots than latent
+    dimensions, verbose prints which form was used. With a rank the
+    solution is truncated to its best rank approximation, stored as a
+    _LowRankLinearAlignment.
     """
 
-    # train settings
-    epochs_max=10000
-    patience=20
-    min_delta=1e-5
+    equations = NormalEquations(data, permutation)
+    equations.extend(n_samples)
 
-    # prepare data with train/validation split
-    indices = permutation[:n_samples]
-    
-    # handle small datasets (< 10 samples)
-    if n_samples < 10:
-        use_val = False
+    if rank is not None:
+        left, right = svd_factors(*equations.product(train_snr))
+        aligner = _LowRankLinearAlignment(left=left[:, :rank].contiguous(), right=right[:, :rank].contiguous())
+    else:
+        F = equations.solve(train_snr)
+        aligner = _LinearAlignment(align_matrix=F.T)
 
-        # use all data for training, no validation split
-        train_indices = indices
-        val_indices = []
+    if verbose:
+        print("least squares on {} pilots solved in the {} form".format(n_samples, equations.path))
 
-    else:
-        use_val = True
-
-        # split into 90 train - 10 validation
-        val_size = max(1, int(0.1 * n_samples))
-        train_size = n_samples - val_size
-        
-        train_indices = indices[:train_size]
-        val_indices = indices[train_size:]
-    
-    # create datasets and dataloaders
-    train_subset = AlignmentSubset(data, train_indices)
-    train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=True)
-    
-    if use_val:
-        val_subset = AlignmentSubset(data, val_indices)
-        val_dataloader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
+    return aligner.cpu()
 
-    # prepare model and optimizer
-    size = resolution * resolution * 3 * 2 // ratio
-    aligner = _MLPAlignment(size, [size]).to(device)
-    channel = Channel("AWGN", train_snr)
-    criterion = nn.MSELoss(reduction='mean')
-    optimizer = optim.Adam(aligner.parameters(), lr=1e-4)
 
-    # init train state
-    best_loss = float('inf')
-    best_model_state = None
-    checks_without_improvement = 0
-    epoch = 0
+def train_linear_aligner_sweep(data, permutation, pilots_sets, train_snr, verbose=False):
+    """
+    Yield (n_samples, aligner) of train_linear_aligner for every pilot count
+    of pilots_sets, in increasing order, with one pass over the pilots.
+    """
 
-    # train loop
-    while True:
-        # training phase
-        aligner.train()
-        train_loss = 0.0
+    equations = NormalEquations(data, permutation)
+    for n_samples in sorted(int(n) for n in pilots_sets):
+        equations.extend(n_samples)
+        F = equations.solve(train_snr)
+        if verbose:
+            print("least squares on {} pilots solved in the {} form".format(n_samples, equations.path))
 
-        for inputs, targets in train_dataloader:
-            if train_snr is not None:
-                inputs = channel(inputs)
+        yield n_samples, _LinearAlignment(align_matrix=F.T).cpu()
 
-            optimizer.zero_grad()
-            outputs = aligner(inputs.to(device))
-            loss = criterion(outputs, targets.to(device))
-            loss = loss * inputs.shape[0]
-            loss.backward()
-            optimizer.step()
-            train_loss += loss.item()
 
-        # validation phase
-        if use_val:
-            aligner.eval()
-            val_loss = 0.0
-            
-            with torch.no_grad():
-                for inputs, targets in val_dataloader:
-                    if train_snr is not None:
-                        inputs = channel(inputs)
-                    
-                    outputs = aligner(inputs.to(device))
-                    loss = criterion(outputs, targets.to(device))
-                    loss = loss * inputs.shape[0]
-                    val_loss += loss.item()
-            
-            # use validation loss for early stopping
-            avg_val_loss = val_loss / len(val_dataloader)
-            current_loss = avg_val_loss
-        else:
-            # use training loss if no validation set
-            avg_train_loss = train_loss / len(train_dataloader)
-            current_loss = avg_train_loss
+def _pilot_tensors(data, indices, device):
+    """
+    Inputs and targets of the pilots at indices, as two contiguous tensors on device.
+    """
 
-        epoch += 1
+    if isinstance(data, AlignmentDataset):
+        # index the cached tensors directly rather than item by item
+        inputs, targets = data.inputs[indices], data.outputs[indices]
+        if data.flat:
+            inputs, targets = inputs.flatten(start_dim=1), targets.flatten(start_dim=1)
+    else:
+        inputs, targets = dataset_to_matrices(AlignmentSubset(data, indices))
 
-        # check if improvement
-        if best_loss - current_loss > min_delta:
-            best_loss = current_loss
-            best_model_state = copy.deepcopy(aligner.state_dict())
-            checks_without_improvement = 0
-        else:
-            checks_without_improvement += 1
+    return inputs.to(device).contiguous(), targets.to(device).contiguous()
 
-        # break if patience exceeded
-        if checks_without_improvement >= patience:
-            break
 
-        # break if max epochs exceeded
-        if epoch > epochs_max:
-            break
+def _split_indices(permutation, n_samples):
+    indices = permutation[:n_samples]
 
-    # restore best model
-    if best_model_state is not None:
-        aligner.load_state_dict(best_model_state)
-    
-    return aligner.cpu(), epoch
+    # handle small datasets (< 10 samples)
+    if n_samples < 10:
+        # use all data for training, no validation split
+        return indices, indices[:0]
 
+    # split into 90 train - 10 validation
+    val_size = max(1, int(0.1 * n_samples))
+    train_size = n_samples - val_size
 
-def train_conv_aligner(data, permutation, n_samples, c, batch_size, train_snr, device):
-    """
-    Train convolutional aligner with Adam optimization using train/validation split.
+    return indices[:train_size], indices[train_size:]
+
+
+def train_aligner(aligner, data, permutation, n_samples, batch_size, train_snr, device,
+                  lr=1e-4, weight_decay=0, patience=20, min_delta=1e-5, epochs_max=10000):
     """
+    Train any aligner with Adam optimization using train/validation split,
+    with early stopping on the validation loss (training loss below 10
+    samples). Returns the best aligner, on the cpu, and the epochs run.
 
-    # train settings
-    epochs_max=10000
-    patience=10
-    min_delta=1e-5
-    regularization = 0.001
+    The pilots are held on device as two tensors and batched by slicing,
+    the best weights are copied into buffers allocated once.
+    """
 
     # prepare data with train/validation split
-    indices = permutation[:n_samples]
-    
-    # handle small datasets (< 10 samples)
-    if n_samples < 10:
-        use_val = False
-
-        # use all data for training, no validation split
-        train_indices = indices
-        val_indices = []
+    train_indices, val_indices = _split_indices(permutation, n_samples)
+    use_val = len(val_indices) > 0
 
-    else:
-        use_val = True
-
-        # split into 90 train - 10 validation
-        val_size = max(1, int(0.1 * n_samples))
-        train_size = n_samples - val_size
-        
-        train_indices = indices[:train_size]
-        val_indices = indices[train_size:]
-    
-    # create datasets and dataloaders
-    train_subset = AlignmentSubset(data, train_indices)
-    train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=True)
-    
+    train_inputs, train_targets = _pilot_tensors(data, train_indices, device)
     if use_val:
-        val_subset = AlignmentSubset(data, val_indices)
-        val_dataloader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
+        val_inputs, val_targets = _pilot_tensors(data, val_indices, device)
 
     # prepare model and optimizer
-    aligner = _ConvolutionalAlignment(in_channels=2*c, out_channels=2*c, kernel_size=5).to(device)
+    aligner = aligner.to(device)
     channel = Channel("AWGN", train_snr)
     criterion = nn.MSELoss(reduction='mean')
-    optimizer = optim.Adam(aligner.parameters(), lr=1e-3, weight_decay=regularization)
+    optimizer = optim.Adam(aligner.parameters(), lr=lr, weight_decay=weight_decay)
+
+    # the state dict shares storage with the live weights
+    state = aligner.state_dict()
+    best_state = {name: torch.empty_like(tensor) for name, tensor in state.items()}
 
     # init train state
     best_loss = float('inf')
-    best_model_state = None
+    improved = False
     checks_without_improvement = 0
     epoch = 0
 
+    n_train = len(train_inputs)
+    n_train_batches = (n_train + batch_size - 1) // batch_size
+
     # train loop
     while True:
         # training phase
         aligner.train()
-        train_loss = 0.0
+        train_loss = torch.zeros((), device=device)
+        order = torch.randperm(n_train).to(device)
 
-        for inputs, targets in train_dataloader:
+        for start in range(0, n_train, batch_size):
+            batch = order[start:start + batch_size]
+            inputs, targets = train_inputs[batch], train_targets[batch]
             if train_snr is not None:
                 inputs = channel(inputs)
 
             optimizer.zero_grad()
-            outputs = aligner(inputs.to(device))
-            loss = criterion(outputs, targets.to(device))
+            outputs = aligner(inputs)
+            loss = criterion(outputs, targets)
             loss = loss * inputs.shape[0]
             loss.backward()
             optimizer.step()
-            train_loss += loss.item()
+            train_loss += loss.detach()
 
         # validation phase
         if use_val:
             aligner.eval()
-            val_loss = 0.0
-            
+            val_loss = torch.zeros((), device=device)
+
             with torch.no_grad():
-                for inputs, targets in val_dataloader:
+                for start in range(0, len(val_inputs), batch_size):
+                    inputs = val_inputs[start:start + batch_size]
                     if train_snr is not None:
                         inputs = channel(inputs)
-                    
-                    outputs = aligner(inputs.to(device))
-                    loss = criterion(outputs, targets.to(device))
-                    loss = loss * inputs.shape[0]
-                    val_loss += loss.item()
-            
+
+                    outputs = aligner(inputs)
+                    loss = criterion(outputs, val_targets[start:start + batch_size])
+                    val_loss += loss * inputs.shape[0]
+
             # use validation loss for early stopping
-            avg_val_loss = val_loss / len(val_dataloader)
-            current_loss = avg_val_loss
+            n_val_batches = (len(val_inputs) + batch_size - 1) // batch_size
+            current_loss = val_loss.item() / n_val_batches
         else:
             # use training loss if no validation set
-            avg_train_loss = train_loss / len(train_dataloader)
-            current_loss = avg_train_loss
+            current_loss = train_loss.item() / n_train_batches
 
         epoch += 1
 
         # check if improvement
         if best_loss - current_loss > min_delta:
             best_loss = current_loss
-            best_model_state = copy.deepcopy(aligner.state_dict())
+            with torch.no_grad():
+                for name, tensor in state.items():
+                    best_state[name].copy_(tensor)
+            improved = True
             checks_without_improvement = 0
         else:
             checks_without_improvement += 1
@@ -537,128 +568,61 @@ def train_conv_aligner(data, permutation, n_samples, c, batch_size, train_snr, d
             break
 
     # restore best model
-    if best_model_state is not None:
-        aligner.load_state_dict(best_model_state)
-    
+    if improved:
+        with torch.no_grad():
+            for name, tensor in state.items():
+                tensor.copy_(best_state[name])
+
     return aligner.cpu(), epoch
 
 
-def train_twoconv_aligner(data, permutation, n_samples, c, batch_size, train_snr, device):
-    """
-    Train convolutional aligner with Adam optimization using train/validation split.
+def train_neural_aligner(data, permutation, n_samples, batch_size, resolution, ratio, train_snr, device, rank=None):
     """
+    Train linear aligner with Adam optimization using train/validation split.
 
-    # train settings
-    epochs_max=10000
-    patience=20
-    min_delta=1e-5
-    regularization = 0.001
+    With a rank the linear layer is factorized as a _LowRankLinearAlignment.
+    """
 
-    # prepare data with train/validation split
-    indices = permutation[:n_samples]
-    
-    # handle small datasets (< 10 samples)
-    if n_samples < 10:
-        use_val = False
+    size = resolution * resolution * 3 * 2 // ratio
+    if rank is not None:
+        aligner = _LowRankLinearAlignment(size=size, rank=rank)
+    else:
+        aligner = _LinearAlignment(size=size)
 
-        # use all data for training, no validation split
-        train_indices = indices
-        val_indices = []
+    return train_aligner(aligner, data, permutation, n_samples, batch_size, train_snr, device, lr=1e-4, patience=20)
 
-    else:
-        use_val = True
-
-        # split into 90 train - 10 validation
-        val_size = max(1, int(0.1 * n_samples))
-        train_size = n_samples - val_size
-        
-        train_indices = indices[:train_size]
-        val_indices = indices[train_size:]
-    
-    # create datasets and dataloaders
-    train_subset = AlignmentSubset(data, train_indices)
-    train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=True)
-    
-    if use_val:
-        val_subset = AlignmentSubset(data, val_indices)
-        val_dataloader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
 
-    # prepare model and optimizer
-    aligner = _TwoConvAlignment(in_channels=2*c, hidden_channels=2*c, out_channels=2*c, kernel_size=5).to(device)
-    channel = Channel("AWGN", train_snr)
-    criterion = nn.MSELoss(reduction='mean')
-    optimizer = optim.Adam(aligner.parameters(), lr=1e-3, weight_decay=regularization)
+def train_mlp_aligner(data, permutation, n_samples, batch_size, resolution, ratio, train_snr, device):
+    """
+    Train MLP aligner with Adam optimization using train/validation split.
+    """
 
-    # init train state
-    best_loss = float('inf')
-    best_model_state = None
-    checks_without_improvement = 0
-    epoch = 0
+    size = resolution * resolution * 3 * 2 // ratio
+    aligner = _MLPAlignment(size, [size])
 
-    # train loop
-    while True:
-        # training phase
-        aligner.train()
-        train_loss = 0.0
+    return train_aligner(aligner, data, permutation, n_samples, batch_size, train_snr, device, lr=1e-4, patience=20)
 
-        for inputs, targets in train_dataloader:
-            if train_snr is not None:
-                inputs = channel(inputs)
 
-            optimizer.zero_grad()
-            outputs = aligner(inputs.to(device))
-            loss = criterion(outputs, targets.to(device))
-            loss = loss * inputs.shape[0]
-            loss.backward()
-            optimizer.step()
-            train_loss += loss.item()
+def train_conv_aligner(data, permutation, n_samples, c, batch_size, train_snr, device):
+    """
+    Train convolutional aligner with Adam optimization using train/validation split.
+    """
 
-        # validation phase
-        if use_val:
-            aligner.eval()
-            val_loss = 0.0
-            
-            with torch.no_grad():
-                for inputs, targets in val_dataloader:
-                    if train_snr is not None:
-                        inputs = channel(inputs)
-                    
-                    outputs = aligner(inputs.to(device))
-                    loss = criterion(outputs, targets.to(device))
-                    loss = loss * inputs.shape[0]
-                    val_loss += loss.item()
-            
-            # use validation loss for early stopping
-            avg_val_loss = val_loss / len(val_dataloader)
-            current_loss = avg_val_loss
-        else:
-            # use training loss if no validation set
-            avg_train_loss = train_loss / len(train_dataloader)
-            current_loss = avg_train_loss
+    aligner = _ConvolutionalAlignment(in_channels=2*c, out_channels=2*c, kernel_size=5)
 
-        epoch += 1
+    return train_aligner(aligner, data, permutation, n_samples, batch_size, train_snr, device,
+                         lr=1e-3, weight_decay=0.001, patience=10)
 
-        # check if improvement
-        if best_loss - current_loss > min_delta:
-            best_loss = current_loss
-            best_model_state = copy.deepcopy(aligner.state_dict())
-            checks_without_improvement = 0
-        else:
-            checks_without_improvement += 1
 
-        # break if patience exceeded
-        if checks_without_improvement >= patience:
-            break
+def train_twoconv_aligner(data, permutation, n_samples, c, batch_size, train_snr, device):
+    """
+    Train two layer convolutional aligner with Adam optimization using train/validation split.
+    """
 
-        # break if max epochs exceeded
-        if epoch > epochs_max:
-            break
+    aligner = _TwoConvAlignment(in_channels=2*c, hidden_channels=2*c, out_channels=2*c, kernel_size=5)
 
-    # restore best model
-    if best_model_state is not None:
-        aligner.load_state_dict(best_model_state)
-    
-    return aligner.cpu(), epoch
+    return train_aligner(aligner, data, permutation, n_samples, batch_size, train_snr, device,
+                         lr=1e-3, weight_decay=0.001, patience=20)
 
 
 def train_zeroshot_aligner(data, permutation, n_samples, train_snr, channel_usage, device):
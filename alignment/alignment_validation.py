@@ -15,32 +15,41 @@ from PIL import Image
 import re
 import os
 import gc
+import time
 
 from utils import image_normalization
 from alignment.alignment_model import *
-from alignment.alignment_model import _LinearAlignment, _MLPAlignment, _ConvolutionalAlignment, _TwoConvAlignment, _ZeroShotAlignment
+from alignment.alignment_model import _LinearAlignment, _MLPAlignment, _ConvolutionalAlignment, _TwoConvAlignment, _ZeroShotAlignment, _LowRankLinearAlignment
 from alignment.alignment_utils import *
 from alignment.alignment_training import *
 from alignment.alignment_validation import *
-from utils import get_psnr
+from utils import get_psnr, set_execution_mode
+from channel import keyed_generator
 
 
-def validation_worker(model, inputs, gt, times, worker_id):
-    """Worker function for parallel model inference"""
+def validation_worker(model, inputs, gt, repeats, worker_id, seed=None, batch_idx=0):
+    """Worker function for parallel model inference, returns one PSNR row per repeat"""
     model.eval()
-    psnr_sum = torch.zeros(inputs.shape[0], device=inputs.device)
+    psnr_runs = []
     
     with torch.no_grad():
-        for _ in range(times):
-            demo_image = model(inputs)
+        for repeat in repeats:
+            generator = None if seed is None else keyed_generator(seed, batch_idx, repeat, device=inputs.device)
+            demo_image = model(inputs, generator=generator)
             demo_image = image_normalization('denormalization')(demo_image)
-            psnr_sum += get_batch_psnr(demo_image, gt)
+            psnr_runs.append(get_batch_psnr(demo_image, gt))
     
-    return psnr_sum / times
+    return torch.stack(psnr_runs)
+
 
+def validation_parallel_inference(model, dataloader, times, device, num_workers=None, seed=None):
+    """
+    Version with parallel inference for multiple runs
 
-def validation_parallel_inference(model, dataloader, times, device, num_workers=None):
-    """Version with parallel inference for multiple runs"""
+    With a seed every (batch, repeat) pair draws its noise from its own keyed
+    generator, so the result is bit-identical to validation_sequential with
+    the same seed whatever the number of workers.
+    """
     model = model.to(device)
     model.eval()
     
@@ -52,7 +61,7 @@ def validation_parallel_inference(model, dataloader, times, device, num_workers=
     total_samples = 0
     
     with torch.no_grad():
-        for inputs, *_ in dataloader:
+        for batch_idx, (inputs, *_) in enumerate(dataloader):
             inputs = inputs.to(device)
             batch_size = inputs.shape[0]
             
@@ -61,35 +70,35 @@ def validation_parallel_inference(model, dataloader, times, device, num_workers=
             
             if times == 1:
                 # No need for parallelization with single run
-                demo_image = model(inputs)
-                demo_image = image_normalization('denormalization')(demo_image)
-                batch_psnr = get_batch_psnr(demo_image, gt).sum().item()
+                batch_psnr = validation_worker(model, inputs, gt, [0], 0, seed, batch_idx)[0].sum().item()
             else:
-                # Parallel inference for multiple runs
-                runs_per_worker = times // num_workers
-                remaining_runs = times % num_workers
-                
-                batch_psnr_sum = torch.zeros(batch_size, device=device)
+                # Parallel inference for multiple runs, repeats are dealt round robin
+                repeats = [list(range(i, times, num_workers)) for i in range(num_workers)]
                 
                 # Use thread pool for GPU parallelization (better for CUDA)
                 with ThreadPoolExecutor(max_workers=num_workers) as executor:
                     futures = []
                     
-                    # Submit jobs with different number of runs per worker
-                    for i in range(num_workers):
-                        worker_runs = runs_per_worker + (1 if i < remaining_runs else 0)
-                        if worker_runs > 0:
+                    for i, worker_repeats in enumerate(repeats):
+                        if len(worker_repeats) > 0:
                             future = executor.submit(
                                 validation_worker, 
-                                model, inputs, gt, worker_runs, i
+                                model, inputs, gt, worker_repeats, i, seed, batch_idx
                             )
-                            futures.append(future)
+                            futures.append((worker_repeats, future))
                     
                     # Collect results
-                    for future in futures:
-                        batch_psnr_sum += future.result()
+                    psnr_runs = [None] * times
+                    for worker_repeats, future in futures:
+                        for repeat, psnr in zip(worker_repeats, future.result()):
+                            psnr_runs[repeat] = psnr
                 
-                batch_psnr = batch_psnr_sum.sum().item()
+                # accumulate in repeat order, as the sequential version does
+                batch_psnr_sum = torch.zeros(batch_size, device=device)
+                for psnr in psnr_runs:
+                    batch_psnr_sum += psnr
+
+                batch_psnr = (batch_psnr_sum / times).sum().item()
             
             total_psnr += batch_psnr
             total_samples += batch_size
@@ -97,13 +106,13 @@ def validation_parallel_inference(model, dataloader, times, device, num_workers=
     return total_psnr / total_samples
 
 
-def validation_parallel_batches(model, dataloader, times, device, num_workers=4):
+def validation_parallel_batches(model, dataloader, times, device, num_workers=4, seed=None):
     """Version with parallel batch processing"""
     model = model.to(device)
     model.eval()
     
-    def process_batch(batch_data):
-        inputs, *_ = batch_data
+    def process_batch(indexed_batch):
+        batch_idx, (inputs, *_) = indexed_batch
         inputs = inputs.to(device)
         batch_size = inputs.shape[0]
         
@@ -114,8 +123,9 @@ def validation_parallel_batches(model, dataloader, times, device, num_workers=4)
         batch_psnr_sum = torch.zeros(batch_size, device=device)
         
         with torch.no_grad():
-            for _ in range(times):
-                demo_image = model(inputs)
+            for repeat in range(times):
+                generator = None if seed is None else keyed_generator(seed, batch_idx, repeat, device=inputs.device)
+                demo_image = model(inputs, generator=generator)
                 demo_image = image_normalization('denormalization')(demo_image)
                 batch_psnr_sum += get_batch_psnr(demo_image, gt)
         
@@ -124,7 +134,7 @@ def validation_parallel_batches(model, dataloader, times, device, num_workers=4)
     
     # Process batches in parallel
     with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        results = list(executor.map(process_batch, dataloader))
+        results = list(executor.map(process_batch, enumerate(dataloader)))
     
     total_psnr = sum(psnr for psnr, _ in results)
     total_samples = sum(samples for _, samples in results)
@@ -180,7 +190,8 @@ def validation_vectorized(model, dataloader, times, device):
     return total_psnr / total_samples
 
 
-def validation(model, dataloader, times, device, method='auto', num_workers=None):
+def validation(model, dataloader, times, device, method='auto', num_workers=None, seed=None,
+               channels_last=False, compile=False):
     """
     Optimized validation with multiple parallelization strategies
     
@@ -190,13 +201,19 @@ def validation(model, dataloader, times, device, method='auto', num_workers=None
         times: Number of inference runs per sample
         method: 'auto', 'vectorized', 'parallel_inference', 'parallel_batches', or 'sequential'
         num_workers: Number of parallel workers (auto-detected if None)
+        seed: Base seed of the keyed noise generators (global rng if None),
+            not supported by the vectorized method
+        channels_last: Convert the model to channels_last, see utils.set_execution_mode
+        compile: Compile encoder, decoder and aligner, see utils.set_execution_mode
     """
+
+    model = set_execution_mode(model.to(device), channels_last, compile)
     
     if method == 'auto':
         # Auto-select best method based on conditions
         if times == 1:
             method = 'sequential'
-        elif times <= 4 and torch.cuda.is_available():
+        elif times <= 4 and torch.cuda.is_available() and seed is None:
             method = 'vectorized'  # Best for GPU with moderate times
         elif times > 4:
             method = 'parallel_inference'  # Best for many inference runs
@@ -204,16 +221,16 @@ def validation(model, dataloader, times, device, method='auto', num_workers=None
             method = 'parallel_batches'  # Best for CPU or complex cases
     
     if method == 'vectorized':
-        return validation_vectorized(model, dataloader, times)
+        return validation_vectorized(model, dataloader, times, device)
     elif method == 'parallel_inference':
-        return validation_parallel_inference(model, dataloader, times, num_workers)
+        return validation_parallel_inference(model, dataloader, times, device, num_workers, seed)
     elif method == 'parallel_batches':
-        return validation_parallel_batches(model, dataloader, times, num_workers)
+        return validation_parallel_batches(model, dataloader, times, device, num_workers or 4, seed)
     else:  # sequential
-        return validation_sequential(model, dataloader, times)
+        return validation_sequential(model, dataloader, times, device, seed)
 
 
-def validation_sequential(model, dataloader, times, device):
+def validation_sequential(model, dataloader, times, device, seed=None):
     """Original optimized sequential version for comparison"""
     model = model.to(device)
     model.eval()
@@ -222,15 +239,16 @@ def validation_sequential(model, dataloader, times, device):
     total_samples = 0
     
     with torch.no_grad():
-        for inputs, *_ in dataloader:
+        for batch_idx, (inputs, *_) in enumerate(dataloader):
             inputs = inputs.to(device)
             batch_size = inputs.shape[0]
             
             gt = image_normalization('denormalization')(inputs)
             batch_psnr_sum = torch.zeros(batch_size, device=device)
             
-            for _ in range(times):
-                demo_image = model(inputs)
+            for repeat in range(times):
+                generator = None if seed is None else keyed_generator(seed, batch_idx, repeat, device=inputs.device)
+                demo_image = model(inputs, generator=generator)
                 demo_image = image_normalization('denormalization')(demo_image)
                 batch_psnr_sum += get_batch_psnr(demo_image, gt)
             
@@ -241,6 +259,41 @@ def validation_sequential(model, dataloader, times, device):
     return total_psnr / total_samples
 
 
+def validation_latent(model, store, times, device, batch_size=64, seed=None):
+    """
+    Sequential validation that streams encoder outputs from a LatentStore.
+
+    Same result as validation_sequential on the loader the store was built
+    from, without running the encoder or decoding images.
+    """
+    model = model.to(device)
+    model.eval()
+
+    total_psnr = 0.0
+    total_samples = 0
+
+    with torch.no_grad():
+        for batch_idx, (latents, inputs) in enumerate(store.batches(batch_size)):
+            latents = latents.to(device)
+            inputs = inputs.to(device)
+            batch_size = inputs.shape[0]
+
+            gt = image_normalization('denormalization')(inputs)
+            batch_psnr_sum = torch.zeros(batch_size, device=device)
+
+            for repeat in range(times):
+                generator = None if seed is None else keyed_generator(seed, batch_idx, repeat, device=inputs.device)
+                demo_image = model.forward_latent(latents, generator=generator)
+                demo_image = image_normalization('denormalization')(demo_image)
+                batch_psnr_sum += get_batch_psnr(demo_image, gt)
+
+            batch_mean_psnr = (batch_psnr_sum / times).sum().item()
+            total_psnr += batch_mean_psnr
+            total_samples += batch_size
+
+    return total_psnr / total_samples
+
+
 def prepare_image(image_path, resolution):
     if resolution is None:
         transform = transforms.Compose([transforms.ToTensor(), ])
@@ -255,7 +308,12 @@ def prepare_image(image_path, resolution):
     return test_image
 
 def prepare_aligner(aligner_fp, device, resolution, c, n_samples=None):
-    if "linear" in aligner_fp or "neural" in aligner_fp:
+    if "lowrank" in aligner_fp:
+        # the rank is read from the saved factors
+        state_dict = torch.load(aligner_fp, map_location=device)
+        aligner = _LowRankLinearAlignment(left=state_dict['left'], right=state_dict['right'])
+
+    elif "linear" in aligner_fp or "neural" in aligner_fp:
         aligner = _LinearAlignment(resolution**2)
     
     elif "mlp" in aligner_fp:
@@ -286,6 +344,65 @@ def prepare_aligner(aligner_fp, device, resolution, c, n_samples=None):
     return aligner
 
 
+def aligner_latency(aligner, size, batch_size=64, repeats=20, device='cpu'):
+    """
+    Mean seconds to apply aligner to a batch of batch_size flat latents of size size.
+    """
+    aligner = aligner.to(device).eval()
+    x = torch.randn(batch_size, size, device=device)
+
+    with torch.no_grad():
+        aligner(x)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            aligner(x)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / repeats
+
+
+def rank_sweep(encoder, decoder, data, permutation, n_samples, train_snr, ranks, dataloader, times, device,
+               val_snr=None):
+    """
+    PSNR, parameter count and apply latency of the least squares aligner
+    truncated to every rank of ranks, next to the dense aligner.
+
+    The least squares solution is decomposed once, every rank is a slice
+    of the same factors.
+    """
+    val_snr = train_snr if val_snr is None else val_snr
+
+    equations = NormalEquations(data, permutation)
+    equations.extend(n_samples)
+    P, Q = equations.product(train_snr)
+    left, right = svd_factors(P, Q)
+    size = left.shape[0]
+
+    aligners = [('dense', _LinearAlignment(align_matrix=(P if Q is None else P @ Q)).cpu())]
+    del P, Q
+    for rank in ranks:
+        aligners.append((rank, _LowRankLinearAlignment(left=left[:, :rank].contiguous(),
+                                                       right=right[:, :rank].contiguous()).cpu()))
+
+    results = []
+    for rank, aligner in aligners:
+        model = AlignedDeepJSCC(encoder, decoder, aligner, val_snr, "AWGN")
+        result = {
+            'rank': rank,
+            'parameters': sum(p.numel() for p in aligner.parameters()),
+            'latency': aligner_latency(aligner, size, device=device),
+            'psnr': validation_vectorized(model, dataloader, times, device),
+        }
+        print("rank {}: {} parameters, {:.3f} ms per batch, PSNR {:.2f}".format(
+            result['rank'], result['parameters'], 1000 * result['latency'], result['psnr']))
+        results.append(result)
+
+    return results
+
+
 def prepare_models(model1_fp, model2_fp, aligner_fp, snr, c, resolution, device):
     model1 = load_deep_jscc(model1_fp, snr, c, "AWGN")
     model2 = load_deep_jscc(model2_fp, snr, c, "AWGN")
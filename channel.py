@@ -1,9 +1,46 @@
+import hashlib
+import math
 import torch
 import torch.nn as nn
 
 
+def keyed_seed(seed, *keys):
+    """
+    Counter based seed: hash of the base seed and of the keys (e.g. batch
+    index, snr and repeat index), independent of the order of the calls.
+    """
+    digest = hashlib.blake2b(repr((seed,) + keys).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') & ((1 << 63) - 1)
+
+
+def keyed_generator(seed, *keys, device='cpu'):
+    generator = torch.Generator(device=device)
+    generator.manual_seed(keyed_seed(seed, *keys))
+    return generator
+
+
+def _randn(shape, ref, generator=None):
+    # a list of generators draws one equal slice of the leading dimension each
+    if isinstance(generator, (list, tuple)):
+        chunk = (shape[0] // len(generator),) + tuple(shape[1:])
+        return torch.cat([_randn(chunk, ref, g) for g in generator])
+    return torch.randn(shape, generator=generator, dtype=ref.dtype, device=ref.device)
+
+
+def _uniform(shape, low, high, ref, generator=None):
+    if isinstance(generator, (list, tuple)):
+        chunk = (shape[0] // len(generator),) + tuple(shape[1:])
+        return torch.cat([_uniform(chunk, low, high, ref, g) for g in generator])
+    return torch.empty(shape, dtype=ref.dtype, device=ref.device).uniform_(low, high, generator=generator)
+
+
+def _sqrt(x):
+    # the noise power is a python number when both signal power and snr are known
+    return torch.sqrt(x) if isinstance(x, torch.Tensor) else math.sqrt(x)
+
+
 class Channel(nn.Module):
-    def __init__(self, channel_type='AWGN', snr=20):
+    def __init__(self, channel_type='AWGN', snr=20, per_sample=False, block_size=None, generator=None):
         if channel_type not in ['AWGN', 'Rayleigh']:
             raise Exception('Unknown type of channel')
         
@@ -15,33 +52,53 @@ class Channel(nn.Module):
         # distribuited is set as uniform
         self.snr = snr
 
-    def forward(self, z_hat):
+        # per sample mode draws one snr and one complex fading coefficient
+        # for every sample (or every block_size complex symbols of a sample)
+        # instead of per element snr and two real coefficients per batch
+        self.per_sample = per_sample
+        self.block_size = block_size
+
+        # noise is drawn from this generator (global rng if None), a generator
+        # passed to forward takes precedence so that concurrent callers can
+        # each use their own stream
+        self.generator = generator
+
+    def forward(self, z_hat, generator=None, sig_pwr=None):
+        # sig_pwr is the known signal power of every sample (e.g. the power
+        # set by the encoder normalization), measured from z_hat if None
+        if generator is None:
+            generator = self.generator
+
         if z_hat.dim() == 3 or z_hat.dim() == 1:
             z_hat = z_hat.unsqueeze(0)
+
+        if self.per_sample:
+            return self._forward_per_sample(z_hat, generator, sig_pwr)
         
-        k = z_hat[0].numel()
+        if sig_pwr is None:
+            k = z_hat[0].numel()
 
-        if z_hat.dim() == 4:
-            sig_pwr = torch.sum(torch.abs(z_hat).square(), dim=(1, 2, 3), keepdim=True) / k
+            if z_hat.dim() == 4:
+                sig_pwr = torch.sum(torch.abs(z_hat).square(), dim=(1, 2, 3), keepdim=True) / k
 
-        elif z_hat.dim() == 2:
-            sig_pwr = torch.sum(torch.abs(z_hat).square(), dim=1, keepdim=True) / k
+            elif z_hat.dim() == 2:
+                sig_pwr = torch.sum(torch.abs(z_hat).square(), dim=1, keepdim=True) / k
 
         # constant snr
         if isinstance(self.snr, (int, float)):
             noi_pwr = sig_pwr / (10 ** (self.snr / 10))
-            noise = torch.randn_like(z_hat) * torch.sqrt(noi_pwr/2)
+            noise = _randn(z_hat.shape, z_hat, generator) * _sqrt(noi_pwr/2)
 
         # variable snr
         else:
-            noi_snr = torch.empty_like(z_hat).uniform_(self.snr[0], self.snr[1])
+            noi_snr = _uniform(z_hat.shape, self.snr[0], self.snr[1], z_hat, generator)
             noi_pwr = sig_pwr / (10 ** (noi_snr / 10))
-            noise = torch.randn_like(z_hat) * torch.sqrt(noi_pwr/2)
+            noise = _randn(z_hat.shape, z_hat, generator) * _sqrt(noi_pwr/2)
 
         if self.channel_type == 'Rayleigh':
             # hc = torch.randn_like(z_hat)  wrong implement before
             # hc = torch.randn(1, device = z_hat.device) 
-            hc = torch.randn(2, device = z_hat.device) 
+            hc = torch.randn(2, generator=generator, device = z_hat.device) 
         
             # clone for in-place operation  
             z_hat = z_hat.clone()
@@ -52,6 +109,100 @@ class Channel(nn.Module):
 
         return z_hat + noise
 
+    def _forward_per_sample(self, z_hat, generator=None, sig_pwr=None):
+        batch_size = z_hat.size(0)
+        ones = (1,) * (z_hat.dim() - 1)
+        k = z_hat[0].numel()
+
+        if sig_pwr is None:
+            sig_pwr = torch.sum(z_hat.square().flatten(1), dim=1).view(batch_size, *ones) / k
+
+        # constant snr
+        if isinstance(self.snr, (int, float)):
+            noi_snr = self.snr
+
+        # variable snr, one value per sample
+        else:
+            noi_snr = _uniform((batch_size,) + ones, self.snr[0], self.snr[1], z_hat, generator)
+
+        noi_pwr = sig_pwr / (10 ** (noi_snr / 10))
+        noise = _randn(z_hat.shape, z_hat, generator) * _sqrt(noi_pwr/2)
+
+        if self.channel_type == 'Rayleigh':
+            z_hat = self._complex_fading(z_hat, generator)
+
+        return z_hat + noise
+
+    def _complex_fading(self, z_hat, generator=None):
+        """
+        Multiply the I/Q symbols by a CN(0, 1) coefficient per sample or per block.
+
+        The first half of the features are the in-phase components and the
+        second half the quadrature ones, as in the per batch fading.
+        """
+        shape = z_hat.shape
+        batch_size = shape[0]
+        i, q = z_hat.flatten(1).chunk(2, dim=1)
+        symbols = i.size(1)
+
+        if self.block_size is None:
+            blocks = 1
+        elif symbols % self.block_size == 0:
+            blocks = symbols // self.block_size
+        else:
+            raise Exception('Number of symbols is not a multiple of the block size')
+
+        i = i.reshape(batch_size, blocks, -1)
+        q = q.reshape(batch_size, blocks, -1)
+
+        # real and imaginary parts have variance 1/2 so that E|h|^2 = 1
+        h = _randn((batch_size, 2, blocks, 1), z_hat, generator) * (0.5 ** 0.5)
+        hr, hi = h[:, 0], h[:, 1]
+
+        z_hat = torch.cat([hr * i - hi * q, hr * q + hi * i], dim=1)
+
+        return z_hat.reshape(shape)
+
+    def sweep(self, z_hat, snr, generator=None, sig_pwr=None):
+        """
+        Apply the channel to the same batch once for every value in `snr`.
+
+        Returns a tensor of shape (len(snr), B, ...) where entry i has been
+        transmitted at snr[i]; every entry draws its own noise and fading.
+        `generator` may also be a list with one generator per snr entry, which
+        makes the result independent of how a sweep is split into calls.
+        """
+        if generator is None:
+            generator = self.generator
+
+        if z_hat.dim() == 3 or z_hat.dim() == 1:
+            z_hat = z_hat.unsqueeze(0)
+
+        snr = torch.as_tensor(snr, dtype=z_hat.dtype, device=z_hat.device).flatten()
+        n = snr.numel()
+        k = z_hat[0].numel()
+        ones = (1,) * (z_hat.dim() - 1)
+
+        # per-sample signal power broadcast against the snr axis
+        if sig_pwr is None:
+            sig_pwr = (torch.sum(torch.abs(z_hat).square().flatten(1), dim=1) / k).view(1, -1, *ones)
+        noi_pwr = sig_pwr / (10 ** (snr.view(n, 1, *ones) / 10))
+        noise = _randn((n,) + z_hat.shape, z_hat, generator) * _sqrt(noi_pwr/2)
+
+        z_hat = z_hat.unsqueeze(0)
+
+        if self.channel_type == 'Rayleigh' and self.per_sample:
+            z_hat = self._complex_fading(z_hat.expand(n, *z_hat.shape[1:]).flatten(0, 1), generator).view(noise.shape)
+
+        elif self.channel_type == 'Rayleigh':
+            # two coefficients per snr entry, one for each half of the channels
+            half = z_hat.size(2) // 2
+            hc = _randn((n, 2), z_hat, generator)
+            hc = torch.cat([hc[:, :1].expand(n, half), hc[:, 1:].expand(n, z_hat.size(2) - half)], dim=1)
+            z_hat = z_hat * hc.view(n, 1, -1, *ones[1:])
+
+        return z_hat + noise
+
     def get_channel(self):
         return self.channel_type, self.snr
 
@@ -0,0 +1,163 @@
+"""
+Training checkpoints written from a background thread.
+
+Every epoch two files are written in the checkpoint directory of a run:
+epoch_<N>.pkl with the model state dict, as before, and state_<N>.pth with
+optimizer, scheduler, RNG and epoch state plus anything the trainer wants to
+keep. Both are written under a temporary name and renamed, so a run killed
+mid write never leaves a truncated file behind, and only the last keep_last
+epochs are kept.
+"""
+
+import os
+import re
+import copy
+import glob
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+_STATE_RE = re.compile(r'state_(\d+)\.pth$')
+
+
+def _snapshot(obj):
+    # copy tensors to the cpu so that training can go on while the copy is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _atomic_save(obj, path):
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class CheckpointWriter:
+    """
+    Background writer of the checkpoints of one run.
+
+    save() snapshots the states on the calling thread and returns, the files
+    are written by the writer thread. At most max_pending snapshots wait to
+    be written, save() blocks when the writer falls behind. close() waits
+    for the pending writes and raises the first error of the writer.
+    """
+
+    def __init__(self, root_ckpt_dir, keep_last=2, max_pending=2):
+        self.root_ckpt_dir = root_ckpt_dir
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, epoch, model, optimizer=None, scheduler=None, extra=None):
+        if self.error is not None:
+            raise self.error
+
+        state = {
+            'epoch': epoch,
+            'optimizer': optimizer.state_dict() if optimizer is not None else None,
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'rng': rng_state(),
+            'extra': extra,
+        }
+        self.queue.put((epoch, _snapshot(model.state_dict()), _snapshot(state)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            epoch, model_state, state = item
+            try:
+                os.makedirs(self.root_ckpt_dir, exist_ok=True)
+                # the model goes first, a state file always has its model file
+                _atomic_save(model_state, os.path.join(self.root_ckpt_dir, 'epoch_{}.pkl'.format(epoch)))
+                _atomic_save(state, os.path.join(self.root_ckpt_dir, 'state_{}.pth'.format(epoch)))
+                self._apply_retention(epoch)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _apply_retention(self, epoch):
+        if self.keep_last is None:
+            return
+        for path in glob.glob(os.path.join(self.root_ckpt_dir, '*_*.p*')):
+            match = re.search(r'(?:epoch|state)_(\d+)\.(?:pkl|pth)$', path)
+            if match is not None and int(match.group(1)) <= epoch - self.keep_last:
+                os.remove(path)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def latest_state(root_ckpt_dir):
+    """
+    Path of the newest state file of a run whose model file exists, None if there is none.
+    """
+    epochs = []
+    for path in glob.glob(os.path.join(root_ckpt_dir, 'state_*.pth')):
+        match = _STATE_RE.search(path)
+        if match is not None and os.path.exists(os.path.join(root_ckpt_dir, 'epoch_{}.pkl'.format(match.group(1)))):
+            epochs.append(int(match.group(1)))
+
+    if len(epochs) == 0:
+        return None
+    return os.path.join(root_ckpt_dir, 'state_{}.pth'.format(max(epochs)))
+
+
+def load_state(root_ckpt_dir):
+    """
+    Load the newest full state of a run, without restoring anything.
+    """
+    path = latest_state(root_ckpt_dir)
+    if path is None:
+        raise Exception('No checkpoint to resume in {}'.format(root_ckpt_dir))
+    # the state holds numpy and python RNG states, not only tensors
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def restore(state, root_ckpt_dir, model, optimizer=None, scheduler=None):
+    """
+    Restore model, optimizer, scheduler and RNG from a state returned by
+    load_state. Returns the epoch to start from.
+    """
+    model_path = os.path.join(root_ckpt_dir, 'epoch_{}.pkl'.format(state['epoch']))
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+
+    if optimizer is not None and state['optimizer'] is not None:
+        optimizer.load_state_dict(state['optimizer'])
+    if scheduler is not None and state['scheduler'] is not None:
+        scheduler.load_state_dict(state['scheduler'])
+    set_rng_state(state['rng'])
+
+    return state['epoch'] + 1
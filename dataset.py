@@ -1,13 +1,37 @@
 import os
-from torch.utils.data import Dataset
+import io
+import json
+import argparse
+import mmap
+import queue
+import tarfile
+import threading
+from multiprocessing import Pool
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
 from PIL import Image
+from tqdm import tqdm
+from distributed import is_main_process, barrier
+
+
+def file_index_path(root):
+    return os.path.normpath(root) + '.index.json'
 
 
 class Vanilla(Dataset):
     def __init__(self, root, transform=None):
         self.root = root
         self.transform = transform
-        self.imgs = os.listdir(root)
+        # the file list written at extraction, listing the directory is slow on large trees
+        if os.path.exists(file_index_path(root)):
+            with open(file_index_path(root)) as f:
+                self.imgs = json.load(f)
+        else:
+            self.imgs = os.listdir(root)
 
     def __getitem__(self, index):
         img_path = os.path.join(self.root, self.imgs[index])
@@ -20,7 +44,403 @@ class Vanilla(Dataset):
         return len(self.imgs)
 
 
+def _is_image(name):
+    return name.lower().endswith(('.jpeg', '.jpg', '.png'))
+
+
+def tar_members(tar_path):
+    """
+    Yield (path, offset, size) of the images in an ILSVRC tar, offset being
+    the position of the data in the file. Images of the nested class tars
+    of the train tar are yielded as <class>/<name>.
+    """
+    with open(tar_path, 'rb') as f, tarfile.open(fileobj=f, mode='r:') as outer:
+        for member in outer:
+            if member.isfile() and member.name.endswith('.tar'):
+                wnid = os.path.splitext(os.path.basename(member.name))[0]
+                # a nested tar opened at its data offset reports offsets in the outer file
+                f.seek(member.offset_data)
+                with tarfile.open(fileobj=f, mode='r:') as inner:
+                    for image in inner:
+                        if image.isfile() and _is_image(image.name):
+                            yield wnid + '/' + os.path.basename(image.name), image.offset_data, image.size
+            elif member.isfile() and _is_image(member.name):
+                yield os.path.basename(member.name), member.offset_data, member.size
+
+
+def build_tar_index(tar_path, index_path=None):
+    """
+    Offsets, sizes and labels of the images in an ILSVRC tar, saved to
+    index_path (tar_path + '.index.npz' by default).
+
+    The label of a train image is the position of its class in the sorted
+    class names, as with ImageFolder. The images of the val tar are
+    labelled 0, as with Vanilla.
+    """
+    if index_path is None:
+        index_path = tar_path + '.index.npz'
+
+    members = sorted(tar_members(tar_path))
+    classes = sorted(set(path.split('/')[0] for path, _, _ in members if '/' in path))
+    label_of = {wnid: i for i, wnid in enumerate(classes)}
+    labels = [label_of[path.split('/')[0]] if '/' in path else 0 for path, _, _ in members]
+
+    np.savez(index_path + '.tmp.npz', offsets=np.array([m[1] for m in members], dtype=np.int64),
+             sizes=np.array([m[2] for m in members], dtype=np.int64), labels=np.array(labels, dtype=np.int64),
+             classes=np.array(classes))
+    os.replace(index_path + '.tmp.npz', index_path)
+    return index_path
+
+
+class TarImageNet(Dataset):
+    """
+    ImageNet served from ILSVRC2012_img_train.tar or ILSVRC2012_img_val.tar
+    without extracting them.
+
+    The member index is built on first use. Images are read from a memory
+    map of the tar and decoded with the JPEG draft mode at the smallest
+    scale still larger than draft_size, so the resize that follows works
+    on a much smaller image than the full decode would give.
+    """
+
+    def __init__(self, tar_path, transform=None, draft_size=128, index_path=None):
+        self.tar_path = tar_path
+        self.transform = transform
+        self.draft_size = draft_size
+        index_path = index_path if index_path is not None else tar_path + '.index.npz'
+        if not os.path.exists(index_path):
+            print("indexing {}".format(tar_path))
+            build_tar_index(tar_path, index_path)
+
+        index = np.load(index_path)
+        self.offsets = index['offsets']
+        self.sizes = index['sizes']
+        self.targets = index['labels']
+        self.classes = [str(name) for name in index['classes']]
+        self.map = None
+
+    def _open(self):
+        # opened lazily, so that every loader worker maps the file on its own
+        if self.map is None:
+            with open(self.tar_path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def __getitem__(self, index):
+        offset, size = int(self.offsets[index]), int(self.sizes[index])
+        img = Image.open(io.BytesIO(self._open()[offset:offset + size]))
+        if self.draft_size is not None:
+            img.draft('RGB', (self.draft_size, self.draft_size))
+        img = img.convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['map'] = None
+        return state
+
+
+def cache_transform(resolution=None):
+    """
+    Transform of the datasets written to a cache: uint8 (C, H, W) tensors,
+    resized to (resolution, resolution) when resolution is given.
+    """
+    if resolution is None:
+        return transforms.PILToTensor()
+    return transforms.Compose([transforms.PILToTensor(),
+                               transforms.Resize((int(resolution), int(resolution)), antialias=True)])
+
+
+def cache_path(cache_dir, dataset_name, split, resolution=None):
+    return os.path.join(cache_dir, '{}_{}_{}'.format(dataset_name, split, resolution or 'native'))
+
+
+def build_cache(dataset, path, batch_size=256, num_workers=0):
+    """
+    Write every image of dataset to path.npy, a (N, C, H, W) uint8 array, and
+    its shape and labels to the index file path.json.
+
+    dataset must return uint8 tensors of one shape, see cache_transform. The
+    index is written last, so an interrupted build is started again.
+    """
+    first = dataset[0][0]
+    shape = (len(dataset),) + tuple(first.shape)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    array = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.uint8, shape=shape)
+    labels = []
+    # decoding is the slow part, the loader workers do it in parallel
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                        collate_fn=lambda batch: batch)
+    start = 0
+    for batch in loader:
+        for image, label in batch:
+            if tuple(image.shape) != shape[1:]:
+                raise Exception('Images of shape {} and {} in the same cache, set a resolution'.format(
+                    tuple(image.shape), shape[1:]))
+            array[start] = image.numpy()
+            labels.append(int(label))
+            start += 1
+    array.flush()
+    del array
+    os.replace(path + '.tmp.npy', path + '.npy')
+
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump({'shape': list(shape), 'labels': labels}, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+class CachedImages(Dataset):
+    """
+    Dataset served from a cache written by build_cache.
+
+    Items are uint8 (C, H, W) views of the memory-mapped array, no copy is
+    made until collation: use collate_cached as collate_fn to get float
+    batches in [0, 1], as ToTensor would give.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json') as f:
+            index = json.load(f)
+        self.shape = tuple(index['shape'])
+        self.labels = index['labels']
+        self.images = None
+
+    def _open(self):
+        # opened lazily, so that every loader worker maps the file on its own;
+        # copy on write, the file is never modified
+        if self.images is None:
+            self.images = np.load(self.path + '.npy', mmap_mode='c')
+        return self.images
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self._open()[index]), self.labels[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+
+def collate_cached(batch):
+    images, labels = default_collate(batch)
+    return images.float().div_(255), labels
+
+
+def cached(dataset, path, num_workers=0):
+    """
+    CachedImages of path, built from dataset the first time.
+
+    Under torchrun only the first rank builds the cache, the other ranks
+    wait for it and open the finished files.
+    """
+    if is_main_process() and not os.path.exists(path + '.json'):
+        print("building cache {}".format(path))
+        build_cache(dataset, path, num_workers=num_workers)
+    barrier()
+    return CachedImages(path)
+
+
+def collate_raw(batch):
+    """
+    Collate uint8 images without converting them: one stacked tensor when
+    all images have the same size, a list of tensors otherwise.
+    """
+    images = [image for image, _ in batch]
+    labels = default_collate([label for _, label in batch])
+    if all(image.shape == images[0].shape for image in images):
+        return torch.stack(images), labels
+    return images, labels
+
+
+def resize_batch(images, resolution=None):
+    """
+    Float (B, C, H, W) batch in [0, 1] of the uint8 images returned by
+    collate_raw, resized to (resolution, resolution) as transforms.Resize
+    would do image by image, but with one interpolation per image size.
+    """
+    if isinstance(images, torch.Tensor):
+        images = images.float().div_(255)
+        if resolution is not None and tuple(images.shape[-2:]) != (resolution, resolution):
+            images = F.interpolate(images, size=(resolution, resolution), mode='bilinear',
+                                   align_corners=False, antialias=True)
+        return images
+
+    if resolution is None:
+        raise Exception('Images of different sizes need a resolution')
+
+    out = torch.empty((len(images), images[0].shape[0], resolution, resolution))
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(tuple(image.shape), []).append(i)
+    for indices in groups.values():
+        out[indices] = resize_batch(torch.stack([images[i] for i in indices]), resolution)
+    return out
+
+
+class BatchTransformLoader:
+    """
+    Wraps a DataLoader built with collate_fn=collate_raw, converts and
+    resizes whole batches on a background thread, prefetch batches ahead.
+
+    The workers of the loader only decode, the float conversion and the
+    resize run once per batch, with intra-op parallelism.
+    """
+
+    def __init__(self, loader, resolution=None, prefetch=2):
+        self.loader = loader
+        self.resolution = None if resolution is None else int(resolution)
+        self.prefetch = prefetch
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    def __len__(self):
+        return len(self.loader)
+
+    @staticmethod
+    def _put(out_queue, item, stop):
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, out_queue, stop):
+        try:
+            for images, labels in self.loader:
+                if not self._put(out_queue, (resize_batch(images, self.resolution), labels), stop):
+                    return
+        except Exception as e:
+            self._put(out_queue, e, stop)
+            return
+        self._put(out_queue, None, stop)
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out_queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # lets the thread exit when the loop is left early
+            stop.set()
+
+
+def _extract_unit(args):
+    """
+    Copy the members of one unit out of the tar and check them, returns
+    (unit name, number of files) or raises.
+    """
+    tar_path, path, name, members = args
+    with open(tar_path, 'rb') as f:
+        for member, offset, size in members:
+            out = os.path.join(path, member)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            f.seek(offset)
+            with open(out, 'wb') as g:
+                g.write(f.read(size))
+
+    for member, _, size in members:
+        out = os.path.join(path, member)
+        if not os.path.exists(out) or os.path.getsize(out) != size:
+            raise Exception('Extraction of {} in {} is corrupt'.format(member, name))
+    return name, len(members)
+
+
+def _units(members, chunk_size=1000):
+    # one unit per class of the train tar, chunks of chunk_size images for the flat val tar
+    groups = {}
+    for member in members:
+        path = member[0]
+        groups.setdefault(path.split('/')[0] if '/' in path else None, []).append(member)
+
+    units = []
+    for wnid, group in sorted(groups.items(), key=lambda item: str(item[0])):
+        if wnid is not None:
+            units.append((wnid, group))
+        else:
+            for start in range(0, len(group), chunk_size):
+                units.append(('chunk_{}'.format(start // chunk_size), group[start:start + chunk_size]))
+    return units
+
+
+def _write_json(obj, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path + '.tmp', path)
+
+
+def extract(tar_path, path, workers=None):
+    """
+    Extract an ILSVRC tar to path with a pool of workers, the nested class
+    tars of the train tar straight to their class directories.
+
+    The work is split in units, one per class or per chunk of val images.
+    Every unit is checked, file count and sizes, and recorded in
+    a manifest next to path, so an interrupted extraction resumes with the units
+    it had not finished. The sorted file list of the top directory is
+    written to the index read by Vanilla.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.normpath(path) + '.manifest.json'
+    manifest = {'done': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    members = sorted(tar_members(tar_path))
+    units = _units(members)
+    todo = [(tar_path, path, name, group) for name, group in units if name not in manifest['done']]
+    print("{}: {} units, {} already extracted".format(tar_path, len(units), len(units) - len(todo)))
+
+    with Pool(workers) as pool:
+        for name, count in tqdm(pool.imap_unordered(_extract_unit, todo), total=len(todo)):
+            manifest['done'][name] = count
+            _write_json(manifest, manifest_path)
+
+    expected = sum(len(group) for _, group in units)
+    extracted = sum(manifest['done'][name] for name, _ in units)
+    if extracted != expected:
+        raise Exception('Extracted {} files of {} in {}'.format(extracted, expected, path))
+
+    if all('/' not in member[0] for member in members):
+        _write_json([member[0] for member in members], file_index_path(path))
+    print("{}: {} files verified".format(path, extracted))
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=None, type=int, help='extraction processes, default one per core')
+    args = parser.parse_args()
+
     data_path = './dataset'
     os.makedirs(data_path, exist_ok=True)
     # ILSVRC2012_img_train.tar and ILSVRC2012_img_val.tar should be downloaded from https://image-net.org/
@@ -33,15 +453,7 @@ def main():
         print("extracting {} dataset".format(phase))
         path = './dataset/ImageNet/{}'.format(phase)
         print('path is {}'.format(path))
-        os.makedirs(path, exist_ok=True)
-        print('tar -xf ./dataset/ILSVRC2012_img_{}.tar -C {}'.format(phase, path))
-        os.system('tar -xf ./dataset/ILSVRC2012_img_{}.tar -C {}'.format(phase, path))
-        if phase == 'train':
-            for tar in os.listdir(path):
-                print('tar -xf {}/{} -C {}/{}'.format(path, tar, path, tar.split('.')[0]))
-                os.makedirs('{}/{}'.format(path, tar.split('.')[0]), exist_ok=True)
-                os.system('tar -xf {}/{} -C {}/{}'.format(path, tar, path, tar.split('.')[0]))
-                os.remove('{}/{}'.format(path, tar))
+        extract('./dataset/ILSVRC2012_img_{}.tar'.format(phase), path, args.workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+"""
+Helpers of the multi-process training launched by torchrun.
+
+    torchrun --standalone --nproc_per_node=4 train.py --dataset imagenet
+
+Every process trains a replica of the model on its shard of the data with
+DistributedDataParallel over the gloo backend, which runs on CPU. Without
+torchrun the training runs in a single process as before.
+
+params['batch_size'] is the batch of every rank, the effective batch of a
+step is batch_size * world size. The replicas start from the same weights,
+each rank draws its own channel noise.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(threads_per_rank=None):
+    """
+    Join the process group when launched by torchrun, returns (rank, world_size).
+
+    Each rank uses threads_per_rank intra-op threads, by default an equal
+    share of the cores of the machine, so ranks do not oversubscribe them.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+
+    rank = int(os.environ['RANK'])
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    if threads_per_rank is None:
+        threads_per_rank = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads_per_rank)
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend='gloo')
+
+    return rank, world_size
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def print_main(*args, **kwargs):
+    """
+    print on the first rank only.
+    """
+    if is_main_process():
+        print(*args, **kwargs)
+
+
+def all_reduce_mean(value):
+    """
+    Mean of a python number over the ranks, the number itself in a single process.
+    """
+    if not dist.is_initialized():
+        return value
+    tensor = torch.tensor(float(value), dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / dist.get_world_size()
+
+
+def barrier():
+    """
+    Wait for every rank, nothing to wait for in a single process.
+    """
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def broadcast_object(obj):
+    """
+    The obj of rank 0 on every rank, obj itself in a single process.
+    """
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+class NullWriter:
+    """
+    Stand-in for the SummaryWriter on the ranks that do not log.
+    """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
@@ -1,7 +1,9 @@
 import torch
-from utils import get_psnr
+from utils import get_psnr, image_normalization
 import os
 from model import DeepJSCC
+from channel import Channel, keyed_generator
+from latent_store import open_latent_store
 from train import evaluate_epoch
 from torchvision import transforms
 from torchvision import datasets
@@ -23,10 +25,64 @@ def eval_snr(model, test_loader, writer, param, times=10):
         test_loss /= times
         psnr = get_psnr(image=None, gt=None, mse=test_loss)
         writer.add_scalar('psnr', psnr, snr)
-        
 
 
-def process_config(config_path, output_dir, dataset_name, times):
+def eval_snr_single_pass(model, test_loader, writer, param, times=10, chunk_size=1024, seed=None, encoded=False):
+    """
+    Same curve as eval_snr, computed with a single pass over the test set.
+
+    Every batch goes through the encoder once, the channel is applied for all
+    (snr, repeat) pairs in one batched op and the noisy latents are decoded in
+    chunks of at most chunk_size images to bound memory. With a seed the
+    noise of every (batch, snr, repeat) is drawn from its own keyed generator,
+    so the curve does not depend on chunk_size or on process scheduling.
+    With encoded=True the loader yields (z, images) pairs, e.g. the batches of
+    a LatentStore, and the encoder is skipped.
+    """
+    snr_list = torch.arange(0, 26, 1, dtype=torch.float)
+    snrs = snr_list.repeat_interleave(times)
+    keys = [(snr, repeat) for snr in snr_list.tolist() for repeat in range(times)]
+    # configs written before per sample channels existed do not have the key
+    channel = Channel(param['channel'], per_sample=param.get('per_sample_channel', False))
+    mse_sum = torch.zeros(len(snrs), device=param['device'])
+
+    model.eval()
+    with torch.no_grad():
+        for iter, (first, second) in enumerate(test_loader):
+            if encoded:
+                z, images = first.to(param['device']), second.to(param['device'])
+            else:
+                images = first.to(param['device'])
+                z = model.encoder(images)
+
+            batch_size = images.shape[0]
+            gt = image_normalization('denormalization')(images)
+
+            step = max(1, chunk_size // batch_size)
+            for start in range(0, len(snrs), step):
+                generator = None
+                if seed is not None:
+                    generator = [keyed_generator(seed, iter, snr, repeat, device=z.device)
+                                 for snr, repeat in keys[start:start + step]]
+                z_hat = channel.sweep(z, snrs[start:start + step], generator, sig_pwr=model.encoder.norm.P)
+                n = z_hat.shape[0]
+                outputs = model.decoder(z_hat.flatten(0, 1))
+                outputs = image_normalization('denormalization')(outputs)
+                outputs = outputs.view(n, batch_size, *gt.shape[1:])
+                mse_sum[start:start + n] += (outputs - gt).square().flatten(1).mean(dim=1)
+
+    # average over batches first and then over the repeats, as eval_snr does
+    test_loss = mse_sum.view(len(snr_list), times).mean(dim=1) / (iter + 1)
+    psnr = get_psnr(image=None, gt=None, mse=test_loss)
+    if writer is not None:
+        for snr, value in zip(snr_list.tolist(), psnr.tolist()):
+            writer.add_scalar('psnr', value, snr)
+
+    return psnr
+
+
+
+def process_config(config_path, output_dir, dataset_name, times, latent_root=None):
     with open(config_path, 'r') as f:
         config = yaml.load(f, Loader=yaml.UnsafeLoader)
         assert dataset_name == config['dataset_name']
@@ -37,7 +93,7 @@ def process_config(config_path, output_dir, dataset_name, times):
         transform = transforms.Compose([transforms.ToTensor(), ])
         test_dataset = datasets.CIFAR10(root='../dataset/', train=False,
                                         download=True, transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=True,
+        test_loader = DataLoader(test_dataset, shuffle=False,
                                  batch_size=params['batch_size'], num_workers=params['num_workers'])
 
     elif dataset_name == 'imagenet':
@@ -45,7 +101,7 @@ def process_config(config_path, output_dir, dataset_name, times):
             [transforms.ToTensor(), transforms.Resize((128, 128))])  # the size of paper is 128
         
         test_dataset = Vanilla(root='../dataset/ImageNet/val', transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=True,
+        test_loader = DataLoader(test_dataset, shuffle=False,
                                  batch_size=params['batch_size'], num_workers=params['num_workers'])
     else:
         raise Exception('Unknown dataset')
@@ -56,7 +112,15 @@ def process_config(config_path, output_dir, dataset_name, times):
     model = model.to(params['device'])
     pkl_list = glob.glob(os.path.join(output_dir, 'checkpoints', name, '*.pkl'))
     model.load_state_dict(torch.load(pkl_list[-1]))
-    eval_snr(model, test_loader, writer, params, times)
+
+    if latent_root is None:
+        eval_snr_single_pass(model, test_loader, writer, params, times, seed=params['seed'])
+    else:
+        # encode the test set once per checkpoint and reuse it on later runs
+        store = open_latent_store(model.encoder, pkl_list[-1], test_loader, params['resolution'],
+                                  root=latent_root, images_key=dataset_name, device=params['device'])
+        eval_snr_single_pass(model, store.batches(params['batch_size']), writer, params, times,
+                             seed=params['seed'], encoded=True)
     writer.close()
 
 def main():
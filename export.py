@@ -0,0 +1,205 @@
+"""
+Export of DeepJSCC and AlignedDeepJSCC as separate transmitter and receiver
+TorchScript artifacts, for deployments where encoder and decoder run on
+different machines.
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from alignment.alignment_model import _ZeroShotAlignment
+
+
+class Transmitter(nn.Module):
+    """
+    Transmitter side: encoder with its power normalization, followed by the
+    zeroshot compression when the aligner is a zeroshot one.
+    """
+
+    def __init__(self, encoder, aligner=None):
+        super(Transmitter, self).__init__()
+        self.encoder = encoder
+        self.zeroshot = type(aligner) == _ZeroShotAlignment
+        self.aligner = aligner if self.zeroshot else None
+
+    def forward(self, x):
+        z = self.encoder(x)
+
+        if self.zeroshot:
+            z = self.aligner.compression(z.flatten(start_dim=1))
+
+        return z
+
+
+class Receiver(nn.Module):
+    """
+    Receiver side: aligner (or zeroshot decompression) followed by the decoder.
+
+    latent_shape is the (C, H, W) shape of the encoder output, needed to undo
+    the flattening of the zeroshot compression.
+    """
+
+    def __init__(self, decoder, aligner=None, latent_shape=None):
+        super(Receiver, self).__init__()
+        self.decoder = decoder
+        self.aligner = aligner
+        self.zeroshot = type(aligner) == _ZeroShotAlignment
+        self.latent_shape = tuple(latent_shape) if latent_shape is not None else None
+
+    def forward(self, z):
+        if self.zeroshot:
+            z = self.aligner.decompression(z)
+            z = z.reshape((-1,) + self.latent_shape)
+
+        elif self.aligner is not None:
+            z = self.aligner(z)
+
+        return self.decoder(z)
+
+
+def split_model(model):
+    """
+    Split a DeepJSCC or AlignedDeepJSCC into eager transmitter and receiver.
+    """
+    aligner = getattr(model, 'aligner', None)
+    transmitter = Transmitter(model.encoder, aligner).eval()
+    latent_shape = None
+
+    if transmitter.zeroshot:
+        # shape of the encoder output for one image, the images are square
+        resolution = int((model.aligner.G_tilde.shape[0] // model.decoder.tconv1.transconv.in_channels) ** 0.5)
+        latent_shape = (model.decoder.tconv1.transconv.in_channels, resolution, resolution)
+
+    receiver = Receiver(model.decoder, aligner, latent_shape).eval()
+
+    return transmitter, receiver
+
+
+def _freeze(module, example):
+    # trace with a batch larger than one: the normalization layer squeezes
+    # single image batches and the trace would keep that branch
+    traced = torch.jit.trace(module, example)
+    return torch.jit.freeze(traced)
+
+
+def load_artifact(path):
+    """
+    Load an exported artifact and optimize it for inference on this machine.
+
+    optimize_for_inference rewrites the graph for the local CPU backend and
+    its output cannot be serialized, so it is applied at load time.
+    """
+    return torch.jit.optimize_for_inference(torch.jit.load(path, map_location='cpu'))
+
+
+def export_split(model, resolution, out_dir, name='deepjscc', example_batch=2):
+    """
+    Write frozen TorchScript artifacts of the transmitter and of the receiver
+    of the model, for images of the given resolution. Load them with
+    load_artifact to get the optimized modules.
+
+    Returns the paths of the transmitter and of the receiver artifacts.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    model = model.cpu().eval()
+    transmitter, receiver = split_model(model)
+
+    example = torch.rand(example_batch, 3, resolution, resolution)
+
+    with torch.no_grad():
+        z = transmitter(example)
+        transmitter_ts = _freeze(transmitter, example)
+        receiver_ts = _freeze(receiver, z)
+
+    transmitter_fp = os.path.join(out_dir, '{}_transmitter.pt'.format(name))
+    receiver_fp = os.path.join(out_dir, '{}_receiver.pt'.format(name))
+    torch.jit.save(transmitter_ts, transmitter_fp)
+    torch.jit.save(receiver_ts, receiver_fp)
+    print("Transmitter saved in {}".format(transmitter_fp))
+    print("Receiver saved in {}".format(receiver_fp))
+
+    return transmitter_fp, receiver_fp
+
+
+def _latency(transmitter, receiver, x, iters, warmup):
+    with torch.no_grad():
+        for _ in range(warmup):
+            receiver(transmitter(x))
+
+        times = []
+        for _ in range(iters):
+            start = time.perf_counter()
+            receiver(transmitter(x))
+            times.append(time.perf_counter() - start)
+
+    return float(np.median(times))
+
+
+def benchmark_export(model, transmitter_fp, receiver_fp, resolution, batch_sizes=(1, 16, 64), iters=20, warmup=10):
+    """
+    Median CPU latency of the eager model against the exported artifacts,
+    transmitter and receiver back to back without the channel.
+    """
+    model = model.cpu().eval()
+    transmitter, receiver = split_model(model)
+    transmitter_ts = load_artifact(transmitter_fp)
+    receiver_ts = load_artifact(receiver_fp)
+
+    results = []
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 3, resolution, resolution)
+        eager = _latency(transmitter, receiver, x, iters, warmup)
+        exported = _latency(transmitter_ts, receiver_ts, x, iters, warmup)
+        results.append({'batch_size': batch_size, 'eager_ms': eager * 1e3, 'exported_ms': exported * 1e3,
+                        'speedup': eager / exported})
+        print("batch {:3d}: eager {:.2f} ms, exported {:.2f} ms, speedup {:.2f}x".format(
+            batch_size, eager * 1e3, exported * 1e3, eager / exported))
+
+    return results
+
+
+def config_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, type=str, help='DeepJSCC checkpoint (.pkl)')
+    parser.add_argument('--decoder_checkpoint', default=None, type=str,
+                        help='checkpoint of the receiver decoder, same as --checkpoint if not given')
+    parser.add_argument('--aligner', default=None, type=str, help='aligner state dict (.pth)')
+    parser.add_argument('--c', default=8, type=int, help='inner channel')
+    parser.add_argument('--resolution', default=96, type=int)
+    parser.add_argument('--n_samples', default=None, type=int, help='pilots of a zeroshot aligner')
+    parser.add_argument('--out', default='./out/export', type=str, help='out_path')
+    parser.add_argument('--name', default='deepjscc', type=str, help='prefix of the artifacts')
+    parser.add_argument('--benchmark', action='store_true', help='compare eager and exported latency')
+    return parser.parse_args()
+
+
+def main():
+    from alignment.alignment_utils import load_deep_jscc
+    from alignment.alignment_model import AlignedDeepJSCC
+    from alignment.alignment_validation import prepare_aligner
+
+    args = config_parser()
+    torch.set_grad_enabled(False)
+
+    model = load_deep_jscc(args.checkpoint, None, args.c, 'AWGN')
+
+    if args.aligner is not None or args.decoder_checkpoint is not None:
+        decoder_fp = args.decoder_checkpoint or args.checkpoint
+        decoder = load_deep_jscc(decoder_fp, None, args.c, 'AWGN').decoder
+        aligner = None
+        if args.aligner is not None:
+            aligner = prepare_aligner(args.aligner, 'cpu', args.resolution, args.c, args.n_samples)
+        model = AlignedDeepJSCC(model.encoder, decoder, aligner, None, 'AWGN')
+
+    transmitter_fp, receiver_fp = export_split(model, args.resolution, args.out, args.name)
+
+    if args.benchmark:
+        benchmark_export(model, transmitter_fp, receiver_fp, args.resolution)
+
+
+if __name__ == '__main__':
+    main()
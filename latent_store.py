@@ -0,0 +1,141 @@
+"""
+On-disk store of encoder outputs for Monte Carlo evaluation.
+
+The encoder is deterministic, only the channel noise changes between runs, so
+the normalized latents of a checkpoint over a test split are computed once and
+kept in memory-mapped .npy files together with the ground truth images.
+"""
+
+import hashlib
+import os
+import numpy as np
+import torch
+
+
+def checkpoint_digest(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def store_key(checkpoint_path, resolution):
+    """
+    Key of a store: hash of the checkpoint contents and of the resolution.
+    """
+    key = '{}_{}'.format(checkpoint_digest(checkpoint_path), resolution)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class LatentStore:
+    """
+    Latents of one encoder over a test split and the matching images.
+
+    Latents live in <root>/<key>/latents.npy, images in <root>/<key>/images.npy
+    or, when images_key is given, in <root>/images_<images_key>.npy so that
+    checkpoints evaluated on the same split share them.
+    """
+
+    def __init__(self, root, key, images_key=None):
+        self.latents_path, self.images_path = self._paths(root, key, images_key)
+        self.latents = np.load(self.latents_path, mmap_mode='r')
+        self.images = np.load(self.images_path, mmap_mode='r')
+
+        if len(self.latents) != len(self.images):
+            raise Exception('Latent store and images have different lengths')
+
+    @staticmethod
+    def _paths(root, key, images_key=None):
+        latents_path = os.path.join(root, key, 'latents.npy')
+        if images_key is None:
+            images_path = os.path.join(root, key, 'images.npy')
+        else:
+            images_path = os.path.join(root, 'images_{}.npy'.format(images_key))
+        return latents_path, images_path
+
+    @classmethod
+    def exists(cls, root, key, images_key=None):
+        return all(os.path.exists(path) for path in cls._paths(root, key, images_key))
+
+    @classmethod
+    def build(cls, encoder, dataloader, root, key, images_key=None, device='cpu'):
+        """
+        Run the encoder over the dataloader once and write the store.
+
+        The dataloader must not shuffle, samples are stored in loader order.
+        Files are written under a temporary name and renamed at the end so an
+        interrupted build never leaves a partial store behind.
+        """
+        latents_path, images_path = cls._paths(root, key, images_key)
+        write_images = not os.path.exists(images_path)
+        os.makedirs(os.path.dirname(latents_path), exist_ok=True)
+
+        n = len(dataloader.dataset)
+        latents, images = None, None
+        start = 0
+
+        encoder = encoder.to(device).eval()
+        with torch.no_grad():
+            for batch, *_ in dataloader:
+                batch = batch.to(device)
+                z = encoder(batch)
+
+                # the normalization layer squeezes batches of a single image
+                if z.dim() == batch.dim() - 1:
+                    z = z.unsqueeze(0)
+
+                if latents is None:
+                    latents = np.lib.format.open_memmap(latents_path + '.tmp', mode='w+', dtype=np.float32,
+                                                        shape=(n,) + tuple(z.shape[1:]))
+                    if write_images:
+                        images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.float32,
+                                                           shape=(n,) + tuple(batch.shape[1:]))
+
+                end = start + batch.shape[0]
+                latents[start:end] = z.cpu().numpy()
+                if write_images:
+                    images[start:end] = batch.cpu().numpy()
+                start = end
+
+        latents.flush()
+        del latents
+        os.replace(latents_path + '.tmp', latents_path)
+
+        if write_images:
+            images.flush()
+            del images
+            os.replace(images_path + '.tmp', images_path)
+
+        return cls(root, key, images_key)
+
+    def __len__(self):
+        return len(self.latents)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.latents[idx])), torch.from_numpy(np.array(self.images[idx]))
+
+    def batches(self, batch_size):
+        """
+        Iterate over (z, images) batches read as contiguous slices of the files.
+        """
+        for start in range(0, len(self), batch_size):
+            yield self[start:start + batch_size]
+
+
+def open_latent_store(encoder, checkpoint_path, dataloader, resolution, root='./latents', images_key=None, device='cpu'):
+    """
+    Return the store of the checkpoint at the given resolution, building it on first use.
+
+    Shared images are keyed by images_key and the resolution, the same split
+    evaluated at another resolution has other images.
+    """
+    key = store_key(checkpoint_path, resolution)
+    if images_key is not None:
+        images_key = '{}_{}'.format(images_key, resolution)
+
+    if LatentStore.exists(root, key, images_key):
+        return LatentStore(root, key, images_key)
+
+    print("Building latent store {} for {}".format(key, checkpoint_path))
+    return LatentStore.build(encoder, dataloader, root, key, images_key, device)
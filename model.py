@@ -8,6 +8,7 @@ Created on Tue Dec  11:00:00 2023
 import torch
 import torch.nn as nn
 from channel import Channel
+from tiling import tiled_forward
 
 
 """ def _image_normalization(norm_type):
@@ -69,6 +70,39 @@ class _TransConvWithPReLU(nn.Module):
         return x
 
 
+class _PowerNormalization(nn.Module):
+    """
+    Scale every sample to average power P per real symbol.
+
+    The per sample norm is a single vectorized reduction and k is read from
+    the shape, so no tensor is allocated on the host and the layer can be
+    traced and compiled. Since the output power is known to be P, the channel
+    can be given it instead of measuring it again.
+    """
+
+    def __init__(self, P=1):
+        super(_PowerNormalization, self).__init__()
+        self.P = P
+
+    def forward(self, z_hat):
+        # kept in fp32 under autocast, the norm of low precision values is unstable
+        z_hat = z_hat.float()
+        if z_hat.dim() == 4:
+            batch_size = z_hat.size(0)
+        elif z_hat.dim() == 3:
+            batch_size = 1
+            z_hat = z_hat.unsqueeze(0)
+        else:
+            raise Exception('Unknown size of input')
+
+        k = z_hat[0].numel()
+        sq_norm = z_hat.flatten(1).square().sum(dim=1).view(-1, 1, 1, 1)
+        tensor = z_hat * torch.rsqrt(sq_norm) * ((self.P * k) ** 0.5)
+        if batch_size == 1:
+            return tensor.squeeze(0)
+        return tensor
+
+
 class _Encoder(nn.Module):
     def __init__(self, c=1, is_temp=False, P=1):
         super(_Encoder, self).__init__()
@@ -80,29 +114,7 @@ class _Encoder(nn.Module):
                                     kernel_size=5, padding=2)  # padding size could be changed here
         self.conv4 = _ConvWithPReLU(in_channels=32, out_channels=32, kernel_size=5, padding=2)
         self.conv5 = _ConvWithPReLU(in_channels=32, out_channels=2*c, kernel_size=5, padding=2)
-        self.norm = self._normlizationLayer(P=P)
-
-    @staticmethod
-    def _normlizationLayer(P=1):
-        def _inner(z_hat: torch.Tensor):
-            if z_hat.dim() == 4:
-                batch_size = z_hat.size()[0]
-                # k = np.prod(z_hat.size()[1:])
-                k = torch.prod(torch.tensor(z_hat.size()[1:]))
-            elif z_hat.dim() == 3:
-                batch_size = 1
-                # k = np.prod(z_hat.size())
-                k = torch.prod(torch.tensor(z_hat.size()))
-            else:
-                raise Exception('Unknown size of input')
-            # k = torch.tensor(k)
-            z_temp = z_hat.reshape(batch_size, 1, 1, -1)
-            z_trans = z_hat.reshape(batch_size, 1, -1, 1)
-            tensor = torch.sqrt(P * k) * z_hat / torch.sqrt((z_temp @ z_trans))
-            if batch_size == 1:
-                return tensor.squeeze(0)
-            return tensor
-        return _inner
+        self.norm = _PowerNormalization(P=P)
 
     def forward(self, x):
         # x = self.imgae_normalization(x)
@@ -142,26 +154,35 @@ class _Decoder(nn.Module):
 
 
 class DeepJSCC(nn.Module):
-    def __init__(self, c, channel_type='AWGN', snr=None):
+    def __init__(self, c, channel_type='AWGN', snr=None, per_sample=False, block_size=None):
         super(DeepJSCC, self).__init__()
         self.encoder = _Encoder(c=c)
         self.snr = snr
         if self.snr is not None:
-            self.channel = Channel(channel_type, snr)
+            self.channel = Channel(channel_type, snr, per_sample, block_size)
         self.decoder = _Decoder(c=c)
 
-    def forward(self, x):
+    def forward(self, x, generator=None):
         z = self.encoder(x)
+        return self.forward_latent(z, generator)
+
+    def forward_latent(self, z, generator=None):
+        # channel and decoder only, for latents that are already encoded
+        # and hence have the power the normalization layer sets
         if hasattr(self, 'channel') and self.channel is not None:
-            z = self.channel(z)
+            z = self.channel(z, generator, sig_pwr=self.encoder.norm.P)
         x_hat = self.decoder(z)
         return x_hat
 
-    def change_channel(self, channel_type='AWGN', snr=None):
+    def forward_tiled(self, x, tile_size=256, overlap=32, memory_budget=256 * 2**20, num_workers=1, seed=None):
+        # bounded memory inference on large images, see tiling.tiled_forward
+        return tiled_forward(self, x, tile_size, overlap, memory_budget, num_workers, seed)
+
+    def change_channel(self, channel_type='AWGN', snr=None, per_sample=False, block_size=None):
         if snr is None:
             self.channel = None
         else:
-            self.channel = Channel(channel_type, snr)
+            self.channel = Channel(channel_type, snr, per_sample, block_size)
 
     def get_channel(self):
         if hasattr(self, 'channel') and self.channel is not None:
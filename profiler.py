@@ -0,0 +1,55 @@
+"""
+Per step timing of the training and evaluation loops.
+
+The loops call mark(phase) at the end of each phase of a step: the time
+since the previous mark is added to that phase. Marks cost a clock read, on
+gpus the phases only include the kernel launches unless synchronize is set,
+which waits for the device at every mark.
+"""
+
+import time
+import torch
+
+
+class StepProfiler:
+    """
+    Time per phase (data, forward, backward, step, sync) and samples per
+    second of the steps of one epoch.
+    """
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.totals = {}
+        self.steps = 0
+        self.samples = 0
+        self.last = None
+        self.begin = None
+
+    def start(self):
+        self.last = self.begin = time.perf_counter()
+
+    def mark(self, phase):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.totals[phase] = self.totals.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def step(self, batch_size):
+        self.steps += 1
+        self.samples += batch_size
+
+    def summary(self):
+        """
+        Milliseconds per step of every phase and samples per second.
+        """
+        steps = max(1, self.steps)
+        summary = {phase: 1000 * total / steps for phase, total in self.totals.items()}
+        wall = self.last - self.begin if self.begin is not None else 0.0
+        summary['samples_per_sec'] = self.samples / wall if wall > 0 else 0.0
+        return summary
+
+    def log(self, writer, prefix, epoch):
+        for name, value in self.summary().items():
+            tag = '{}/_samples_per_sec' if name == 'samples_per_sec' else '{}/_ms_' + name
+            writer.add_scalar(tag.format(prefix), value, epoch)
@@ -0,0 +1,182 @@
+"""
+Post-training static int8 quantization of the DeepJSCC encoder and decoder
+for CPU inference, and a report of its PSNR loss and throughput gain.
+"""
+
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from eval import eval_snr_single_pass
+
+
+class _FloatPReLU(nn.Module):
+    """
+    PReLU kept in float inside a quantized graph.
+
+    The quantized PReLU kernel is inaccurate for the slopes the models learn,
+    and the decoder shares one PReLU module between four layers, which a
+    single set of output qparams cannot cover. FX lowers every nn.PReLU to
+    the quantized kernel, so the modules are swapped for this opaque leaf.
+    """
+
+    def __init__(self, prelu):
+        super(_FloatPReLU, self).__init__()
+        self.prelu = prelu
+
+    def forward(self, x):
+        return self.prelu(x)
+
+
+def _wrap_prelu(module, wrapped=None):
+    # shared modules are wrapped once, so sharing is preserved
+    wrapped = {} if wrapped is None else wrapped
+    for name, child in module.named_children():
+        if isinstance(child, nn.PReLU):
+            if id(child) not in wrapped:
+                wrapped[id(child)] = _FloatPReLU(child)
+            setattr(module, name, wrapped[id(child)])
+        else:
+            _wrap_prelu(child, wrapped)
+    return module
+
+
+def quantize_model(model, calib_loader, num_batches=32, backend='fbgemm'):
+    """
+    Return a copy of a DeepJSCC with int8 encoder and decoder.
+
+    The convolutions are quantized, the PReLUs and the power normalization
+    stay in float. Activations are calibrated on num_batches batches of
+    calib_loader sent through the model channel, so the decoder sees noisy
+    latents. The default backend is fbgemm: the x86 one returns wrong results
+    for the stride 1 transposed convolutions of the decoder.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    custom_config = {'non_traceable_module_class': [_FloatPReLU]}
+
+    model = copy.deepcopy(model).cpu().eval()
+    _wrap_prelu(model.encoder)
+    _wrap_prelu(model.decoder)
+    images = next(iter(calib_loader))[0]
+
+    with torch.no_grad():
+        z = model.encoder(images)
+
+        # the normalization has data dependent control flow, keep it as a float leaf
+        model.encoder = prepare_fx(model.encoder, qconfig_mapping, (images,),
+                                   prepare_custom_config=dict(custom_config, non_traceable_module_name=['norm']))
+        model.decoder = prepare_fx(model.decoder, qconfig_mapping, (z,), prepare_custom_config=custom_config)
+
+        for batch_idx, (images, _) in enumerate(calib_loader):
+            if batch_idx >= num_batches:
+                break
+            model(images)
+
+    model.encoder = convert_fx(model.encoder)
+    model.decoder = convert_fx(model.decoder)
+
+    return model
+
+
+def measure_throughput(model, data_loader, num_batches=10, warmup=2):
+    """
+    Images per second of encoder and decoder, without the channel.
+    """
+    model = model.cpu().eval()
+    n_images = 0
+    elapsed = 0.0
+
+    with torch.no_grad():
+        for batch_idx, (images, _) in enumerate(data_loader):
+            if batch_idx >= num_batches + warmup:
+                break
+
+            start = time.perf_counter()
+            model.decoder(model.encoder(images))
+            if batch_idx >= warmup:
+                elapsed += time.perf_counter() - start
+                n_images += images.shape[0]
+
+    return n_images / elapsed
+
+
+def quantization_report(model, qmodel, test_loader, param, times=10, num_batches=10):
+    """
+    PSNR of the fp32 and int8 models at every snr of eval.eval_snr, and the
+    measured throughput of both.
+    """
+    param = dict(param, device='cpu')
+    psnr_fp32 = eval_snr_single_pass(model.cpu(), test_loader, None, param, times, seed=param.get('seed'))
+    psnr_int8 = eval_snr_single_pass(qmodel, test_loader, None, param, times, seed=param.get('seed'))
+
+    throughput_fp32 = measure_throughput(model, test_loader, num_batches)
+    throughput_int8 = measure_throughput(qmodel, test_loader, num_batches)
+
+    report = {
+        'snr': list(range(0, 26, 1)),
+        'psnr_fp32': psnr_fp32.tolist(),
+        'psnr_int8': psnr_int8.tolist(),
+        'psnr_loss': (psnr_fp32 - psnr_int8).tolist(),
+        'throughput_fp32': throughput_fp32,
+        'throughput_int8': throughput_int8,
+        'speedup': throughput_int8 / throughput_fp32,
+    }
+
+    for snr, fp32, int8 in zip(report['snr'], report['psnr_fp32'], report['psnr_int8']):
+        print("snr {:2d}: fp32 {:.2f} dB, int8 {:.2f} dB, loss {:.2f} dB".format(snr, fp32, int8, fp32 - int8))
+    print("throughput: fp32 {:.1f} img/s, int8 {:.1f} img/s, speedup {:.2f}x".format(
+        throughput_fp32, throughput_int8, report['speedup']))
+    print("mean psnr loss: {:.2f} dB".format(np.mean(report['psnr_loss'])))
+
+    return report
+
+
+def config_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, type=str, help='DeepJSCC checkpoint (.pkl)')
+    parser.add_argument('--c', default=8, type=int, help='inner channel')
+    parser.add_argument('--dataset', default='cifar10', type=str,
+                        choices=['cifar10', 'imagenet', 'imagenette'], help='dataset')
+    parser.add_argument('--resolution', default=96, type=int)
+    parser.add_argument('--channel', default='AWGN', type=str, choices=['AWGN', 'Rayleigh'], help='channel')
+    parser.add_argument('--snr', default=10, type=float, help='snr of the calibration batches')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--calib_batches', default=32, type=int)
+    parser.add_argument('--times', default=10, type=int, help='monte carlo runs per snr')
+    parser.add_argument('--backend', default='fbgemm', type=str, choices=['x86', 'fbgemm', 'qnnpack', 'onednn'])
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--out', default=None, type=str, help='path of the yaml report and int8 state dict')
+    return parser.parse_args()
+
+
+def main():
+    import os
+    import yaml
+    from alignment.alignment_utils import load_deep_jscc
+    from alignment.alignment_training import get_data_loaders
+
+    args = config_parser()
+    model = load_deep_jscc(args.checkpoint, args.snr, args.c, args.channel)
+    train_loader, test_loader = get_data_loaders(args.dataset, args.resolution, args.batch_size, args.num_workers)
+
+    qmodel = quantize_model(model, train_loader, args.calib_batches, args.backend)
+    param = {'channel': args.channel, 'device': 'cpu', 'seed': args.seed}
+    report = quantization_report(model, qmodel, test_loader, param, args.times)
+
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+        name = os.path.splitext(os.path.basename(args.checkpoint))[0]
+        torch.save(qmodel.state_dict(), os.path.join(args.out, name + '_int8.pkl'))
+        with open(os.path.join(args.out, name + '_int8.yaml'), 'w') as f:
+            yaml.dump(report, f)
+
+
+if __name__ == '__main__':
+    main()
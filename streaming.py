@@ -0,0 +1,262 @@
+"""
+Pipelined encode -> channel -> decode of a stream of frames.
+
+Preprocessing, encoder, channel and decoder run as separate stages on a
+thread pool, connected by bounded queues, so that consecutive micro-batches
+are in different stages at the same time. The encoder stage groups frames
+into micro-batches, the later stages work on whole batches and the frames
+come out one by one, in input order.
+"""
+
+import queue
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from torchvision import transforms
+
+from channel import keyed_generator
+from export import split_model
+
+
+# end of stream marker, forwarded from stage to stage
+_END = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _StageError:
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+
+
+def _to_tensor(frame):
+    return frame if isinstance(frame, torch.Tensor) else transforms.ToTensor()(frame)
+
+
+class StageStats:
+    """
+    Counters of one stage: items and batches processed, time spent working
+    and occupancy of the input queue, sampled at every read.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.wall = 0.0
+        self.queue_sum = 0
+        self.queue_max = 0
+        self.reads = 0
+
+    def sample_queue(self, size):
+        self.queue_sum += size
+        self.queue_max = max(self.queue_max, size)
+        self.reads += 1
+
+    def summary(self):
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'batches': self.batches,
+            # items per second of work, what the stage could sustain alone
+            'throughput': self.items / self.busy if self.busy > 0 else 0.0,
+            'utilization': self.busy / self.wall if self.wall > 0 else 0.0,
+            'queue_mean': self.queue_sum / self.reads if self.reads > 0 else 0.0,
+            'queue_max': self.queue_max,
+        }
+
+
+class StreamingPipeline:
+    """
+    Streaming inference of a DeepJSCC or AlignedDeepJSCC.
+
+    preprocess turns a frame into a (C, H, W) float tensor in [0, 1], by
+    default PIL images and arrays go through ToTensor. batch_size is the
+    largest micro-batch, the encoder waits at most batch_timeout seconds for
+    more frames before sending a partial one. queue_size bounds every queue,
+    in frames for the first one and in micro-batches for the others.
+    """
+
+    def __init__(self, model, preprocess=None, batch_size=8, queue_size=4, batch_timeout=0.01,
+                 device='cpu', seed=None):
+        self.model = model.to(device).eval()
+        self.transmitter, self.receiver = split_model(self.model)
+        if self.transmitter.zeroshot:
+            # compressed zeroshot latents are laid out pilots first, not batch first
+            raise Exception('Zeroshot aligners are not supported by the streaming pipeline')
+        self.channel = getattr(self.model, 'channel', None)
+
+        self.preprocess = preprocess if preprocess is not None else _to_tensor
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.batch_timeout = batch_timeout
+        self.device = device
+        self.seed = seed
+        self.stats = {}
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def _get(self, q, timeout=None):
+        # raises queue.Empty after timeout seconds, _Stopped when the run is closed
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self._stop.is_set():
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.perf_counter())
+            if wait <= 0:
+                raise queue.Empty()
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+    def _preprocess_stage(self, frames, out_queue, stats):
+        for frame in frames:
+            start = time.perf_counter()
+            x = self.preprocess(frame)
+            stats.busy += time.perf_counter() - start
+            stats.items += 1
+            self._put(out_queue, x)
+
+        self._put(out_queue, _END)
+
+    def _encoder_stage(self, in_queue, out_queue, stats):
+        ended = False
+        while not ended:
+            stats.sample_queue(in_queue.qsize())
+            first = self._get(in_queue)
+            if first is _END or isinstance(first, _StageError):
+                self._put(out_queue, first)
+                return
+
+            # micro-batch: take what arrives within batch_timeout, up to batch_size
+            frames = [first]
+            deadline = time.perf_counter() + self.batch_timeout
+            while len(frames) < self.batch_size:
+                try:
+                    frame = self._get(in_queue, timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if isinstance(frame, _StageError):
+                    self._put(out_queue, frame)
+                    return
+                if frame is _END:
+                    ended = True
+                    break
+                frames.append(frame)
+
+            start = time.perf_counter()
+            x = torch.stack(frames).to(self.device)
+            z = self.transmitter(x)
+            # the normalization layer squeezes batches of a single image
+            if z.dim() == x.dim() - 1:
+                z = z.unsqueeze(0)
+            stats.busy += time.perf_counter() - start
+            stats.items += len(frames)
+            stats.batches += 1
+            self._put(out_queue, z)
+
+        self._put(out_queue, _END)
+
+    def _batch_stage(self, fn, in_queue, out_queue, stats):
+        batch_idx = 0
+        while True:
+            stats.sample_queue(in_queue.qsize())
+            z = self._get(in_queue)
+            if z is _END or isinstance(z, _StageError):
+                self._put(out_queue, z)
+                return
+
+            start = time.perf_counter()
+            z = fn(z, batch_idx)
+            stats.busy += time.perf_counter() - start
+            stats.items += z.shape[0]
+            stats.batches += 1
+            batch_idx += 1
+            self._put(out_queue, z)
+
+    def _channel(self, z, batch_idx):
+        if self.channel is None:
+            return z
+        generator = None if self.seed is None else keyed_generator(self.seed, batch_idx, device=z.device)
+        return self.channel(z, generator, sig_pwr=self.model.encoder.norm.P)
+
+    def _decoder(self, z, batch_idx):
+        return self.receiver(z)
+
+    def _run_stage(self, name, target, *args):
+        stats = self.stats[name]
+        out_queue = args[-1]
+        start = time.perf_counter()
+        try:
+            # grad mode is thread local, set it in every stage
+            with torch.no_grad():
+                target(*args, stats)
+        except _Stopped:
+            pass
+        except Exception as e:
+            try:
+                self._put(out_queue, _StageError(name, e))
+            except _Stopped:
+                pass
+        finally:
+            stats.wall = time.perf_counter() - start
+
+    def run(self, frames):
+        """
+        Yield the decoded frames (C, H, W) of an iterable of frames, in order.
+
+        An exception raised by a stage is raised again here. Closing the
+        generator early stops all the stages.
+        """
+        names = ['preprocess', 'encoder', 'channel', 'decoder']
+        self.stats = {name: StageStats(name) for name in names}
+        self._stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size * (self.batch_size if i == 0 else 1)) for i in range(4)]
+
+        def channel(in_queue, out_queue, stats):
+            self._batch_stage(self._channel, in_queue, out_queue, stats)
+
+        def decoder(in_queue, out_queue, stats):
+            self._batch_stage(self._decoder, in_queue, out_queue, stats)
+
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            executor.submit(self._run_stage, 'preprocess', self._preprocess_stage, frames, queues[0])
+            executor.submit(self._run_stage, 'encoder', self._encoder_stage, queues[0], queues[1])
+            executor.submit(self._run_stage, 'channel', channel, queues[1], queues[2])
+            executor.submit(self._run_stage, 'decoder', decoder, queues[2], queues[3])
+
+            try:
+                while True:
+                    x_hat = queues[3].get()
+                    if x_hat is _END:
+                        break
+                    if isinstance(x_hat, _StageError):
+                        raise Exception('Stage {} failed'.format(x_hat.stage)) from x_hat.error
+                    for frame in x_hat:
+                        yield frame
+            finally:
+                # lets blocked stages exit before the pool is shut down
+                self._stop.set()
+
+    def report(self):
+        """
+        Per stage throughput, utilization and input queue occupancy of the last run.
+        """
+        summaries = [stats.summary() for stats in self.stats.values()]
+        for s in summaries:
+            print("{:10s} {:6d} items {:5d} batches {:9.1f} items/s busy {:5.1%} queue mean {:.2f} max {}".format(
+                s['stage'], s['items'], s['batches'], s['throughput'], s['utilization'],
+                s['queue_mean'], s['queue_max']))
+        return summaries
@@ -0,0 +1,123 @@
+"""
+Tiled inference of the fully convolutional DeepJSCC models on large images.
+
+The image is split into overlapping tiles aligned to the stride 4 grid of the
+encoder. Tiles are encoded, sent through the channel and decoded in batches
+whose size is set by a memory budget, and the decoded tiles are blended back
+with weights that ramp down linearly over the overlap, so the seams do not
+show. Every tile is a separate transmission: the power normalization and the
+channel apply to each tile on its own.
+"""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn.functional as F
+from channel import keyed_generator
+
+
+# the encoder downsamples by 4, tile sizes and offsets stay on this grid
+_GRID = 4
+
+# upper bound of the activations alive at once in encoder and decoder,
+# in values per pixel of the tile
+_VALUES_PER_PIXEL = 16
+
+
+def _round_up(x, multiple):
+    return int(math.ceil(x / multiple)) * multiple
+
+
+def _tile_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _ramp(length, overlap, ref):
+    # strictly positive, so pixels covered by a single tile keep their value
+    weight = torch.ones(length, dtype=ref.dtype, device=ref.device)
+    n = min(overlap, length // 2)
+    if n > 0:
+        ramp = torch.arange(1, n + 1, dtype=ref.dtype, device=ref.device) / (n + 1)
+        weight[:n] = ramp
+        weight[length - n:] = ramp.flip(0)
+    return weight
+
+
+def tile_batch_size(tile_h, tile_w, memory_budget, element_size=4):
+    """
+    Number of tiles that fit in memory_budget bytes of activations.
+    """
+    return max(1, int(memory_budget // (_VALUES_PER_PIXEL * tile_h * tile_w * element_size)))
+
+
+def tiled_forward(model, x, tile_size=256, overlap=32, memory_budget=256 * 2**20, num_workers=1, seed=None):
+    """
+    Run model on x (C, H, W) or (B, C, H, W) tile by tile.
+
+    tile_size and overlap must be multiples of 4. memory_budget is the bytes
+    of activations allowed to one tile batch, num_workers tile batches are
+    processed concurrently by threads. With a seed every tile batch draws its
+    noise from a keyed generator, so for a given memory budget the result
+    does not depend on num_workers.
+
+    Aligners that act on the flattened latent (linear, mlp, zeroshot) need
+    tile_size equal to the resolution they were trained at.
+    """
+    if tile_size % _GRID != 0 or overlap % _GRID != 0:
+        raise Exception('Tile size and overlap must be multiples of {}'.format(_GRID))
+    if overlap >= tile_size:
+        raise Exception('Overlap must be smaller than the tile size')
+
+    squeeze = x.dim() == 3
+    if squeeze:
+        x = x.unsqueeze(0)
+
+    batch_size, channels, height, width = x.shape
+
+    # pad to the encoder grid, reflection avoids dark borders in the last tiles
+    pad_h = _round_up(height, _GRID) - height
+    pad_w = _round_up(width, _GRID) - width
+    if pad_h > 0 or pad_w > 0:
+        mode = 'reflect' if min(height, width) > max(pad_h, pad_w) else 'replicate'
+        x = F.pad(x, (0, pad_w, 0, pad_h), mode=mode)
+
+    padded_h, padded_w = x.shape[-2:]
+    tile_h, tile_w = min(tile_size, padded_h), min(tile_size, padded_w)
+    stride = tile_size - overlap
+    boxes = [(top, left) for top in _tile_starts(padded_h, tile_h, stride)
+             for left in _tile_starts(padded_w, tile_w, stride)]
+
+    window = _ramp(tile_h, overlap, x)[:, None] * _ramp(tile_w, overlap, x)[None, :]
+    chunk = tile_batch_size(tile_h, tile_w, memory_budget, x.element_size()) // batch_size
+    chunk = max(1, chunk)
+
+    def run(start):
+        tiles = torch.cat([x[:, :, top:top + tile_h, left:left + tile_w] for top, left in boxes[start:start + chunk]])
+        generator = None if seed is None else keyed_generator(seed, start, device=x.device)
+        # grad mode is thread local, set it in the worker
+        with torch.no_grad():
+            decoded = model(tiles, generator=generator)
+        return decoded.view(-1, batch_size, channels, tile_h, tile_w)
+
+    output = torch.zeros_like(x)
+    weight = torch.zeros(padded_h, padded_w, dtype=x.dtype, device=x.device)
+    starts = list(range(0, len(boxes), chunk))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # at most num_workers decoded batches are held at once
+        for i in range(0, len(starts), num_workers):
+            futures = [(start, executor.submit(run, start)) for start in starts[i:i + num_workers]]
+            for start, future in futures:
+                for (top, left), decoded in zip(boxes[start:start + chunk], future.result()):
+                    output[:, :, top:top + tile_h, left:left + tile_w] += decoded * window
+                    weight[top:top + tile_h, left:left + tile_w] += window
+
+    output = (output / weight)[:, :, :height, :width]
+
+    if squeeze:
+        return output.squeeze(0)
+    return output
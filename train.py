@@ -5,18 +5,26 @@ Created on Tue Dec  17:00:00 2023
 @author: chun
 """
 import os
+import copy
 import torch
 import torch.nn as nn
 from torchvision import transforms
 from torchvision import datasets
 from torch.utils.data import DataLoader
 import torch.optim as optim
+from torch.func import functional_call, vmap
 from tqdm import tqdm
 from model import DeepJSCC, ratio2filtersize
-from torch.nn.parallel import DataParallel
-from utils import image_normalization, set_seed, save_model, view_model_param
+from torch.nn.parallel import DataParallel, DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from utils import image_normalization, set_seed, save_model, view_model_param, set_execution_mode, autocast
+from checkpoint import CheckpointWriter, load_state, restore
+from profiler import StepProfiler
+from distributed import init_distributed, cleanup_distributed, is_main_process, all_reduce_mean, broadcast_object, \
+    NullWriter, get_rank, get_world_size, print_main
 from fractions import Fraction
-from dataset import Vanilla
+from dataset import Vanilla, TarImageNet, cache_transform, cache_path, cached, collate_cached, collate_raw, \
+    resize_batch, BatchTransformLoader
 import numpy as np
 import time
 from tensorboardX import SummaryWriter
@@ -24,45 +32,148 @@ import glob
 import argparse
 
 
-def train_epoch(model, optimizer, param, data_loader):
+def unwrap(model):
+    # the DeepJSCC inside a DataParallel or DistributedDataParallel wrapper
+    return model.module if isinstance(model, (DataParallel, DistributedDataParallel)) else model
+
+
+def train_epoch(model, optimizer, param, data_loader, profiler=None):
     model.train()
-    epoch_loss = 0
+    # the device the model ended up on, cpu when param['device'] has no gpu
+    device = next(model.parameters()).device
+    profiler = profiler if profiler is not None else StepProfiler()
+    # summed on the device, read once per epoch
+    epoch_loss = torch.zeros((), device=device)
 
+    profiler.start()
     for iter, (images, _) in enumerate(data_loader):
-        images = images.cuda() if param['parallel'] and torch.cuda.device_count(
-        ) > 1 else images.to(param['device'])
+        profiler.mark('data')
+        images = images.to(device)
+        if param.get('channels_last', False):
+            images = images.contiguous(memory_format=torch.channels_last)
         optimizer.zero_grad()
-        outputs = model.forward(images)
-        outputs = image_normalization('denormalization')(outputs)
+        with autocast(param.get('precision', 'fp32'), images.device):
+            outputs = model.forward(images)
+        # the loss is computed in fp32
+        outputs = image_normalization('denormalization')(outputs.float())
         images = image_normalization('denormalization')(images)
-        loss = model.loss(images, outputs) if not param['parallel'] else model.module.loss(
-            images, outputs)
+        loss = unwrap(model).loss(images, outputs)
+        profiler.mark('forward')
         loss.backward()
+        profiler.mark('backward')
         optimizer.step()
-        epoch_loss += loss.detach().item()
-    epoch_loss /= (iter + 1)
+        epoch_loss += loss.detach()
+        profiler.mark('step')
+        profiler.step(images.shape[0])
+    # mean over the ranks in distributed training
+    epoch_loss = all_reduce_mean(epoch_loss.item() / (iter + 1))
+    profiler.mark('sync')
 
     return epoch_loss, optimizer
 
 
-def evaluate_epoch(model, param, data_loader):
+def evaluate_epoch(model, param, data_loader, profiler=None):
     model.eval()
-    epoch_loss = 0
+    device = next(model.parameters()).device
+    profiler = profiler if profiler is not None else StepProfiler()
+    epoch_loss = torch.zeros((), device=device)
 
     with torch.no_grad():
+        profiler.start()
         for iter, (images, _) in enumerate(data_loader):
-            images = images.cuda() if param['parallel'] and torch.cuda.device_count(
-            ) > 1 else images.to(param['device'])
-            outputs = model.forward(images)
-            outputs = image_normalization('denormalization')(outputs)
+            profiler.mark('data')
+            images = images.to(device)
+            if param.get('channels_last', False):
+                images = images.contiguous(memory_format=torch.channels_last)
+            with autocast(param.get('precision', 'fp32'), images.device):
+                outputs = model.forward(images)
+            outputs = image_normalization('denormalization')(outputs.float())
             images = image_normalization('denormalization')(images)
-            loss = model.loss(images, outputs) if not param['parallel'] else model.module.loss(
-                images, outputs)
-            epoch_loss += loss.detach().item()
-        epoch_loss /= (iter + 1)
+            loss = unwrap(model).loss(images, outputs)
+            epoch_loss += loss.detach()
+            profiler.mark('forward')
+            profiler.step(images.shape[0])
+        epoch_loss = all_reduce_mean(epoch_loss.item() / (iter + 1))
+        profiler.mark('sync')
 
     return epoch_loss
 
+
+def _stack_params(modules):
+    # differentiable stack of the parameters of identical modules, for vmap.
+    # the decoder layers share one PReLU module, it is swapped once under its
+    # first name and functional_call runs without weight tying, whose restore
+    # of the aliases would leave the batched tensor in the module
+    named = [dict(module.named_parameters()) for module in modules]
+    return {name: torch.stack([p[name] for p in named]) for name in named[0]}
+
+
+def _vmap_call(module, params, x, in_dims):
+    return vmap(lambda p, x: functional_call(module, p, (x,), tie_weights=False), in_dims=in_dims)(params, x)
+
+
+def multi_forward(models, images):
+    """
+    Forward of N DeepJSCC with the same inner channel on the same images.
+
+    Encoders and decoders run once for all the models, vmapped over their
+    stacked weights, and every model applies its own channel in between.
+    Returns a (N, B, C, H, W) tensor.
+    """
+    z = _vmap_call(models[0].encoder, _stack_params([model.encoder for model in models]), images, (0, None))
+    z = torch.stack([model.channel(z_i, sig_pwr=model.encoder.norm.P) for model, z_i in zip(models, z)])
+    return _vmap_call(models[0].decoder, _stack_params([model.decoder for model in models]), z, (0, 0))
+
+
+def _multi_losses(models, param, images):
+    images = images.to(param['device'])
+    if param.get('channels_last', False):
+        images = images.contiguous(memory_format=torch.channels_last)
+    with autocast(param.get('precision', 'fp32'), images.device):
+        outputs = multi_forward(models, images)
+    outputs = image_normalization('denormalization')(outputs.float())
+    images = image_normalization('denormalization')(images)
+    return torch.stack([model.loss(images, output) for model, output in zip(models, outputs)])
+
+
+def train_epoch_multi(groups, param, data_loader):
+    """
+    One epoch of every group of (models, optimizers), each batch is loaded
+    once and fed to all the groups. Returns the epoch losses of every group.
+    """
+    epoch_losses = [torch.zeros(len(models)) for models, _ in groups]
+    for models, _ in groups:
+        for model in models:
+            model.train()
+
+    for batch_idx, (images, _) in enumerate(data_loader):
+        for (models, optimizers), epoch_loss in zip(groups, epoch_losses):
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            losses = _multi_losses(models, param, images)
+            # the models share no parameter, each one gets the gradient of its own loss
+            losses.sum().backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            epoch_loss += losses.detach().cpu()
+
+    return [(epoch_loss / (batch_idx + 1)).tolist() for epoch_loss in epoch_losses]
+
+
+def evaluate_epoch_multi(groups, param, data_loader):
+    epoch_losses = [torch.zeros(len(models)) for models in groups]
+    for models in groups:
+        for model in models:
+            model.eval()
+
+    with torch.no_grad():
+        for batch_idx, (images, _) in enumerate(data_loader):
+            for models, epoch_loss in zip(groups, epoch_losses):
+                epoch_loss += _multi_losses(models, param, images).cpu()
+
+    return [(epoch_loss / (batch_idx + 1)).tolist() for epoch_loss in epoch_losses]
+
+
 def parse_snr(value):
     from ast import literal_eval
 
@@ -88,6 +199,34 @@ def config_parser_pipeline():
                         choices=['AWGN', 'Rayleigh'], help='channel')
     parser.add_argument('--seed', default='42', help='seed')
     parser.add_argument('--resolution', default=None, type=int)
+    parser.add_argument('--per_sample_channel', action='store_true',
+                        help='draw snr and fading per sample instead of per element/batch')
+    parser.add_argument('--channels_last', action='store_true', help='run the models in channels_last')
+    parser.add_argument('--compile', action='store_true', help='compile encoder and decoder with torch.compile')
+    parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'bf16'],
+                        help='bf16 runs forward passes under autocast')
+    parser.add_argument('--multi_model', action='store_true',
+                        help='train the whole seed x ratio x snr grid at once on the same batches')
+    parser.add_argument('--seed_list', default=None, nargs='+', type=int,
+                        help='seeds of the multi model grid and of the halving candidates')
+    parser.add_argument('--lr_list', default=None, nargs='+', type=float,
+                        help='initial learning rates of the halving candidates, default the one of the dataset')
+    parser.add_argument('--keep_checkpoints', default=2, type=int, help='epochs of checkpoints kept per run')
+    parser.add_argument('--resume', default=None, type=str, help='checkpoint directory of the run to resume')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='serve the datasets from uint8 caches in this directory, built on first use')
+    parser.add_argument('--imagenet_tar', action='store_true',
+                        help='read imagenet from the ILSVRC2012 tars in ../dataset instead of the extracted tree')
+    parser.add_argument('--profile_sync', action='store_true',
+                        help='synchronize the gpu at every profiled phase, exact per phase times but slower')
+    parser.add_argument('--halving', action='store_true',
+                        help='successive halving of the seed x lr candidates of every (ratio, snr) cell: '
+                             'short runs first, only the best candidates of each cell go on')
+    parser.add_argument('--halving_min_epochs', default=10, type=int, help='epochs of the first rung')
+    parser.add_argument('--halving_eta', default=3, type=int,
+                        help='fraction of the candidates kept and budget growth between rungs')
+    parser.add_argument('--threads_per_rank', default=None, type=int,
+                        help='intra-op threads of every process under torchrun, default cores / processes')
 
     return parser.parse_args()
 
@@ -95,7 +234,24 @@ def config_parser_pipeline():
 def main_pipeline():
     args = config_parser_pipeline()
 
-    print("Training Start")
+    # joins a process group only when launched by torchrun
+    rank, world_size = init_distributed(args.threads_per_rank)
+    if world_size > 1 and args.multi_model:
+        raise Exception('--multi_model is not supported in distributed training')
+
+    if args.resume is not None:
+        if args.multi_model:
+            raise Exception('--resume is not supported with --multi_model')
+        # the run goes on with the params it was started with
+        params = load_state(args.resume)['extra']['params']
+        params['resume'] = args.resume
+        params['distributed'] = world_size > 1
+        print_main("Training Resume")
+        train_pipeline(params)
+        cleanup_distributed()
+        return
+
+    print_main("Training Start")
     dataset_name = args.dataset
 
     out_dir = args.out
@@ -111,6 +267,23 @@ def main_pipeline():
     params['channel'] = args.channel
     params['seed'] = int(args.seed)
     params['resolution'] = args.resolution
+    params['per_sample_channel'] = args.per_sample_channel
+    params['channels_last'] = args.channels_last
+    params['compile'] = args.compile
+    params['precision'] = args.precision
+    params['multi_model'] = args.multi_model
+    params['seed_list'] = args.seed_list if args.seed_list is not None else [params['seed']]
+    params['keep_checkpoints'] = args.keep_checkpoints
+    params['resume'] = None
+    # under torchrun batch_size is the batch of every rank
+    params['distributed'] = world_size > 1
+    params['cache_dir'] = args.cache_dir
+    params['imagenet_tar'] = args.imagenet_tar
+    params['profile_sync'] = args.profile_sync
+    params['halving'] = args.halving
+    params['halving_min_epochs'] = args.halving_min_epochs
+    params['halving_eta'] = args.halving_eta
+    params['lr_list'] = args.lr_list
 
     if dataset_name == 'cifar10':
         params['batch_size'] = 64  # 1024
@@ -162,8 +335,22 @@ def main_pipeline():
     else:
         raise Exception('Unknown dataset')
 
+    if params['lr_list'] is None:
+        params['lr_list'] = [params['init_lr']]
+
+    if params['multi_model']:
+        if params['halving']:
+            raise Exception('--halving is not supported with --multi_model')
+        train_pipeline_multi(params)
+        return
+
     set_seed(params['seed'])
 
+    if params['halving']:
+        train_pipeline_halving(params)
+        cleanup_distributed()
+        return
+
     for ratio in params['ratio_list']:
         for snr in params['snr_list']:
             params['ratio'] = ratio
@@ -171,122 +358,270 @@ def main_pipeline():
 
             train_pipeline(params)
 
+    cleanup_distributed()
 
-# add train_pipeline to with only dataset_name args
-def train_pipeline(params):
 
+def build_loaders(params):
+    """
+    Train and test DataLoaders of params['dataset'].
+    """
     dataset_name = params['dataset']
+    # preprocessed uint8 copies of the datasets, built on first use
+    cache_dir = params.get('cache_dir')
     # load data
     if dataset_name == 'cifar10':
         resolution = params['resolution']
-        if resolution is None:
+        if cache_dir is not None:
+            transform = cache_transform(resolution)
+        elif resolution is None:
             transform = transforms.Compose([transforms.ToTensor(), ])
         else:
-            transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((int(resolution), int(resolution)))])
+            # decode only, the batches are resized after collation
+            transform = cache_transform()
 
         train_dataset = datasets.CIFAR10(root='../dataset/', train=True,
                                          download=True, transform=transform)
 
-        train_loader = DataLoader(train_dataset, shuffle=True,
-                                  batch_size=params['batch_size'], num_workers=params['num_workers'])
         test_dataset = datasets.CIFAR10(root='../dataset/', train=False,
                                         download=False, transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=True,
-                                 batch_size=params['batch_size'], num_workers=params['num_workers'])
         
     elif dataset_name == 'imagenette':
 
         resolution = params['resolution']
-        if resolution is None:
+        if cache_dir is not None:
+            transform = cache_transform(resolution)
+        elif resolution is None:
             transform = transforms.Compose([transforms.ToTensor(), ])
         else:
-            transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((int(resolution), int(resolution)))])
+            # decode only, the batches are resized after collation
+            transform = cache_transform()
 
         train_dataset = datasets.Imagenette(root='../dataset/', split='train',
                                          download=True, transform=transform)
 
-        train_loader = DataLoader(train_dataset, shuffle=True,
-                                  batch_size=params['batch_size'], num_workers=params['num_workers'])
         test_dataset = datasets.Imagenette(root='../dataset/', split='val',
                                         download=False, transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=True,
-                                 batch_size=params['batch_size'], num_workers=params['num_workers'])
 
     elif dataset_name == 'imagenet':
 
-        transform = transforms.Compose(
-            [transforms.ToTensor(), transforms.Resize((128, 128))])  # the size of paper is 128
-        print("loading data of imagenet")
-
-        train_dataset = datasets.ImageFolder(root='../dataset/ImageNet/train', transform=transform)
+        resolution = 128  # the size of paper is 128
+        if cache_dir is not None:
+            transform = cache_transform(resolution)
+        else:
+            transform = cache_transform()
+        print_main("loading data of imagenet")
+
+        if params.get('imagenet_tar', False):
+            # read from the ILSVRC tars, nothing to extract
+            train_dataset = TarImageNet('../dataset/ILSVRC2012_img_train.tar', transform=transform,
+                                        draft_size=resolution)
+            test_dataset = TarImageNet('../dataset/ILSVRC2012_img_val.tar', transform=transform,
+                                       draft_size=resolution)
+        else:
+            train_dataset = datasets.ImageFolder(root='../dataset/ImageNet/train', transform=transform)
 
-        train_loader = DataLoader(train_dataset, shuffle=True,
-                                  batch_size=params['batch_size'], num_workers=params['num_workers'])
-        test_dataset = Vanilla(root='../dataset/ImageNet/val', transform=transform)
-        test_loader = DataLoader(test_dataset, shuffle=True,
-                                 batch_size=params['batch_size'], num_workers=params['num_workers'])
+            test_dataset = Vanilla(root='../dataset/ImageNet/val', transform=transform)
     else:
         raise Exception('Unknown dataset')
 
-    # create model
-    image_fisrt = train_dataset.__getitem__(0)[0]
-    c = ratio2filtersize(image_fisrt, params['ratio'])
-    print("The snr is {}, the inner channel is {}, the ratio is {:.2f}".format(
-        params['snr'], c, params['ratio']))
-    model = DeepJSCC(c=c, channel_type=params['channel'], snr=params['snr'])
+    collate_fn = None
+    if cache_dir is not None:
+        train_dataset = cached(train_dataset, cache_path(cache_dir, dataset_name, 'train', resolution),
+                               params['num_workers'])
+        test_dataset = cached(test_dataset, cache_path(cache_dir, dataset_name, 'val', resolution),
+                              params['num_workers'])
+        collate_fn = collate_cached
+    batched = cache_dir is None and resolution is not None
+    if batched:
+        collate_fn = collate_raw
+
+    train_sampler, test_sampler = None, None
+    if params.get('distributed', False):
+        # every rank reads its own shard of the data
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=params['seed'])
+        test_sampler = DistributedSampler(test_dataset, shuffle=False)
+
+    train_loader = DataLoader(train_dataset, shuffle=train_sampler is None, sampler=train_sampler,
+                              batch_size=params['batch_size'], num_workers=params['num_workers'],
+                              collate_fn=collate_fn)
+    test_loader = DataLoader(test_dataset, shuffle=test_sampler is None, sampler=test_sampler,
+                             batch_size=params['batch_size'], num_workers=params['num_workers'],
+                             collate_fn=collate_fn)
+    if batched:
+        train_loader = BatchTransformLoader(train_loader, resolution)
+        test_loader = BatchTransformLoader(test_loader, resolution)
+
+    return train_loader, test_loader
+
+
+def first_image(loader):
+    """
+    First image of the loader as the model sees it, float (C, H, W) at the training resolution.
+    """
+    image = loader.dataset[0][0]
+    if isinstance(loader, BatchTransformLoader):
+        # the dataset holds the decoded images, they are resized per batch
+        return resize_batch(image[None], loader.resolution)[0]
+    return image.float()  # cached datasets hold uint8
 
-    # init exp dir
+
+def build_scheduler(optimizer, params):
+    if params['if_scheduler'] and not params['ReduceLROnPlateau']:
+        scheduler = optim.lr_scheduler.StepLR(
+            optimizer, step_size=params['step_size'], gamma=params['gamma'])
+    elif params['ReduceLROnPlateau']:
+        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
+                                                         factor=params['lr_reduce_factor'],
+                                                         patience=params['lr_schedule_patience'],
+                                                         verbose=False)
+    else:
+        print_main("No scheduler")
+        scheduler = None
+    return scheduler
+
+
+def run_dirs(params, c):
+    """
+    Log, checkpoint and config paths of one run in params['out_dir'].
+    """
     out_dir = params['out_dir']
-    phaser = dataset_name.upper() + '_' + str(c) + '_' + str(params['snr']) + '_' + \
+    if params.get('resume') is not None:
+        # a resumed run keeps writing in the directories it was started in
+        phaser = os.path.basename(os.path.normpath(params['resume']))
+        return out_dir + '/' + 'logs/' + phaser, params['resume'], out_dir + '/' + 'configs/' + phaser
+
+    phaser = params['dataset'].upper() + '_' + str(c) + '_' + str(params['snr']) + '_' + \
         "{:.2f}".format(params['ratio']) + '_' + str(params['channel']) + \
         '_' + time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')
+    # runs of a multi seed grid start in the same second
+    if len(params.get('seed_list', [])) > 1:
+        phaser += '_seed_' + str(params['seed'])
+    if len(params.get('lr_list', [])) > 1:
+        phaser += '_lr_' + str(params['init_lr'])
+    # the ranks may not start in the same second, all use the name of rank 0
+    phaser = broadcast_object(phaser)
     root_log_dir = out_dir + '/' + 'logs/' + phaser
     root_ckpt_dir = out_dir + '/' + 'checkpoints/' + phaser
     root_config_dir = out_dir + '/' + 'configs/' + phaser
-    writer = SummaryWriter(log_dir=root_log_dir)
+    return root_log_dir, root_ckpt_dir, root_config_dir
+
+
+def write_results(writer, params, model, c, train_loss, test_loss, epoch, t0, per_epoch_time, root_config_dir):
+    """
+        Write the results in out_dir/results folder
+    """
+    dataset_name = params['dataset']
+
+    writer.add_text(tag='result', text_string="""Dataset: {}\nparams={}\n\nTotal Parameters: {}\n\n
+    FINAL RESULTS\nTEST Loss: {:.4f}\nTRAIN Loss: {:.4f}\n\n
+    Convergence Time (Epochs): {:.4f}\nTotal Time Taken: {:.4f} hrs\nAverage Time Per Epoch: {:.4f} s\n\n\n"""
+                    .format(dataset_name, params, view_model_param(model), np.mean(np.array(train_loss)),
+                            np.mean(np.array(test_loss)), epoch, (time.time() - t0) / 3600, np.mean(per_epoch_time)))
+    writer.close()
+    if not os.path.exists(os.path.dirname(root_config_dir)):
+        os.makedirs(os.path.dirname(root_config_dir))
+    with open(root_config_dir + '.yaml', 'w') as f:
+        dict_yaml = {'dataset_name': dataset_name, 'params': params,
+                     'inner_channel': c, 'total_parameters': view_model_param(model)}
+        import yaml
+        yaml.dump(dict_yaml, f)
+
+
+# add train_pipeline to with only dataset_name args
+def train_pipeline(params):
+
+    dataset_name = params['dataset']
+    # load data
+    train_loader, test_loader = build_loaders(params)
+
+    # create model
+    image_fisrt = first_image(train_loader)
+    c = ratio2filtersize(image_fisrt, params['ratio'])
+    print_main("The snr is {}, the inner channel is {}, the ratio is {:.2f}".format(
+        params['snr'], c, params['ratio']))
+    model = DeepJSCC(c=c, channel_type=params['channel'], snr=params['snr'],
+                     per_sample=params['per_sample_channel'])
+
+    # init exp dir
+    root_log_dir, root_ckpt_dir, root_config_dir = run_dirs(params, c)
+    # only the first rank logs and writes checkpoints
+    writer = SummaryWriter(log_dir=root_log_dir) if is_main_process() else NullWriter()
 
     # model init
     device = torch.device(params['device'] if torch.cuda.is_available() else 'cpu')
-    if params['parallel'] and torch.cuda.device_count() > 1:
+    if params.get('distributed', False):
+        # one process per replica, the gradients are averaged over gloo
+        model = model.to(device)
+        set_execution_mode(model, params['channels_last'], params['compile'])
+        model = DistributedDataParallel(model)
+    elif params['parallel'] and torch.cuda.device_count() > 1:
         model = DataParallel(model, device_ids=list(range(torch.cuda.device_count())))
         model = model.cuda()
+        set_execution_mode(model, params['channels_last'], params['compile'])
     else:
         model = model.to(device)
+        set_execution_mode(model, params['channels_last'], params['compile'])
 
     # opt
     optimizer = optim.Adam(
         model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
-    if params['if_scheduler'] and not params['ReduceLROnPlateau']:
-        scheduler = optim.lr_scheduler.StepLR(
-            optimizer, step_size=params['step_size'], gamma=params['gamma'])
-    elif params['ReduceLROnPlateau']:
-        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
-                                                         factor=params['lr_reduce_factor'],
-                                                         patience=params['lr_schedule_patience'],
-                                                         verbose=False)
-    else:
-        print("No scheduler")
-        scheduler = None
+    scheduler = build_scheduler(optimizer, params)
 
     writer.add_text('config', str(params))
     t0 = time.time()
     epoch_train_losses, epoch_val_losses = [], []
     per_epoch_time = []
+    start_epoch = 0
+
+    if params.get('resume') is not None:
+        state = load_state(root_ckpt_dir)
+        start_epoch = restore(state, root_ckpt_dir, unwrap(model), optimizer, scheduler)
+        epoch = state['epoch']
+        epoch_train_losses = state['extra']['train_losses']
+        epoch_val_losses = state['extra']['val_losses']
+        per_epoch_time = state['extra']['per_epoch_time']
+        # max_time counts the time spent before the restart too
+        t0 = time.time() - state['extra']['elapsed']
+        if state['extra'].get('finished', False):
+            # the run already met its stopping condition, only the final evaluation is left
+            start_epoch = params['epochs']
+            print_main("{} finished at epoch {}, nothing to resume".format(root_ckpt_dir, epoch))
+        else:
+            print_main("Resuming {} from epoch {}".format(root_ckpt_dir, start_epoch))
+
+    if get_rank() > 0:
+        # the replicas start from the same weights, but every rank draws its own
+        # channel noise; rank 0 keeps its seeded or restored RNG, the checkpoints
+        # only hold that one, so the others also move on with the start epoch
+        set_seed(params['seed'] + get_rank() + start_epoch * get_world_size())
+
+    checkpoints = None
+    if is_main_process():
+        checkpoints = CheckpointWriter(root_ckpt_dir, keep_last=params.get('keep_checkpoints', 2))
 
     # train
     # At any point you can hit Ctrl + C to break out of training early.
     try:
-        with tqdm(range(params['epochs']), disable=params['disable_tqdm']) as t:
+        with tqdm(range(start_epoch, params['epochs']),
+                  disable=params['disable_tqdm'] or not is_main_process()) as t:
             for epoch in t:
 
                 t.set_description('Epoch %d' % epoch)
+                if params.get('distributed', False):
+                    # a different shuffle of the shards every epoch
+                    train_loader.sampler.set_epoch(epoch)
 
                 start = time.time()
 
+                train_profiler = StepProfiler(params.get('profile_sync', False))
                 epoch_train_loss, optimizer = train_epoch(
-                    model, optimizer, params, train_loader)
+                    model, optimizer, params, train_loader, train_profiler)
+                train_time = time.time() - start
 
-                epoch_val_loss = evaluate_epoch(model, params, test_loader)
+                val_start = time.time()
+                val_profiler = StepProfiler(params.get('profile_sync', False))
+                epoch_val_loss = evaluate_epoch(model, params, test_loader, val_profiler)
+                val_time = time.time() - val_start
 
                 epoch_train_losses.append(epoch_train_loss)
                 epoch_val_losses.append(epoch_val_loss)
@@ -294,35 +629,234 @@ def train_pipeline(params):
                 writer.add_scalar('train/_loss', epoch_train_loss, epoch)
                 writer.add_scalar('val/_loss', epoch_val_loss, epoch)
                 writer.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
+                # images per second, to compare the precision modes
+                writer.add_scalar('train/_throughput', len(train_loader.dataset) / train_time, epoch)
+                writer.add_scalar('val/_throughput', len(test_loader.dataset) / val_time, epoch)
+                # per step breakdown: waiting on data, forward, backward, step, final sync
+                train_profiler.log(writer, 'train', epoch)
+                val_profiler.log(writer, 'val', epoch)
 
                 t.set_postfix(time=time.time() - start, lr=optimizer.param_groups[0]['lr'],
+                              throughput=len(train_loader.dataset) / train_time,
                               train_loss=epoch_train_loss, val_loss=epoch_val_loss)
 
                 per_epoch_time.append(time.time() - start)
 
-                # Saving checkpoint
-
-                if not os.path.exists(root_ckpt_dir):
-                    os.makedirs(root_ckpt_dir)
-                torch.save(model.state_dict(), '{}.pkl'.format(
-                    root_ckpt_dir + "/epoch_" + str(epoch)))
-
-                files = glob.glob(root_ckpt_dir + '/*.pkl')
-                for file in files:
-                    epoch_nb = file.split('_')[-1]
-                    epoch_nb = int(epoch_nb.split('.')[0])
-                    if epoch_nb < epoch - 1:
-                        os.remove(file)
-
                 if params['ReduceLROnPlateau'] and scheduler is not None:
                     scheduler.step(epoch_val_loss)
                 elif params['if_scheduler'] and not params['ReduceLROnPlateau']:
                     scheduler.step()  # use only information from the validation loss
 
-                if optimizer.param_groups[0]['lr'] < params['min_lr']:
-                    print("\n!! LR EQUAL TO MIN LR SET.")
+                # stopping conditions, checked before the checkpoint so that it
+                # records a finished run and a resume does not train past them
+                min_lr_reached = optimizer.param_groups[0]['lr'] < params['min_lr']
+                # Stop training after params['max_time'] hours, every rank stops
+                # at the same epoch as soon as one of them is over time
+                max_time_elapsed = all_reduce_mean(float(time.time() - t0 > params['max_time'] * 3600)) > 0
+
+                # Saving checkpoint, after the scheduler step so that a resumed run
+                # starts from the state the next epoch would have seen
+                if checkpoints is not None:
+                    checkpoints.save(epoch, unwrap(model), optimizer, scheduler, extra={
+                        'params': params, 'train_losses': epoch_train_losses, 'val_losses': epoch_val_losses,
+                        'per_epoch_time': per_epoch_time, 'elapsed': time.time() - t0,
+                        'finished': min_lr_reached or max_time_elapsed})
+
+                if min_lr_reached:
+                    print_main("\n!! LR EQUAL TO MIN LR SET.")
+                    break
+
+                if max_time_elapsed:
+                    print_main('-' * 89)
+                    print_main("Max_time for training elapsed {:.2f} hours, so stopping".format(
+                        params['max_time']))
                     break
 
+    except KeyboardInterrupt:
+        print_main('-' * 89)
+        print_main('Exiting from training early because of KeyboardInterrupt')
+
+    if checkpoints is not None:
+        checkpoints.close()
+
+    test_loss = evaluate_epoch(model, params, test_loader)
+    train_loss = evaluate_epoch(model, params, train_loader)
+    if is_main_process():
+        print("Test Accuracy: {:.4f}".format(test_loss))
+        print("Train Accuracy: {:.4f}".format(train_loss))
+        print("Convergence Time (Epochs): {:.4f}".format(epoch))
+        print("TOTAL TIME TAKEN: {:.4f}s".format(time.time() - t0))
+        print("AVG TIME PER EPOCH: {:.4f}s".format(np.mean(per_epoch_time)))
+
+        write_results(writer, params, unwrap(model), c, train_loss, test_loss, epoch, t0, per_epoch_time,
+                      root_config_dir)
+
+    del model, optimizer, scheduler, train_loader, test_loader
+    del writer
+
+    return test_loss, root_ckpt_dir
+
+
+def train_pipeline_halving(params):
+    """
+    Successive halving over the seed x learning rate candidates of every
+    (ratio, snr) cell of the grid.
+
+    Every candidate of params['seed_list'] x params['lr_list'] is trained for
+    params['halving_min_epochs'] epochs in every cell. Within each cell the
+    best 1 / params['halving_eta'] candidates by final test loss go on to a
+    budget halving_eta times larger, resumed from their checkpoints, and so
+    on until params['epochs'], so only about one candidate per cell pays
+    the full budget. Candidates are only compared to candidates of the same
+    cell: the loss of a higher snr or ratio is always lower, ranking across
+    cells would only keep that corner of the grid.
+    """
+    eta = params['halving_eta']
+    if len(params['seed_list']) * len(params['lr_list']) < 2:
+        raise Exception('--halving needs at least two candidates per cell, set --seed_list or --lr_list')
+    budget = min(params['halving_min_epochs'], params['epochs'])
+    runs = [{'ratio': ratio, 'snr': snr, 'seed': seed, 'lr': lr, 'ckpt_dir': None}
+            for ratio in params['ratio_list'] for snr in params['snr_list']
+            for seed in params['seed_list'] for lr in params['lr_list']]
+
+    rung = 0
+    while True:
+        print_main("Rung {}: {} runs for {} epochs".format(rung, len(runs), budget))
+        for run in runs:
+            run_params = dict(params)
+            run_params['ratio'] = run['ratio']
+            run_params['snr'] = run['snr']
+            run_params['seed'] = run['seed']
+            run_params['init_lr'] = run['lr']
+            run_params['epochs'] = budget
+            run_params['resume'] = run['ckpt_dir']
+            if run['ckpt_dir'] is None:
+                set_seed(run['seed'])
+            run['loss'], run['ckpt_dir'] = train_pipeline(run_params)
+
+        cells = {}
+        for run in sorted(runs, key=lambda run: run['loss']):
+            cells.setdefault((run['ratio'], run['snr']), []).append(run)
+        for cell_runs in cells.values():
+            for run in cell_runs:
+                print_main("snr {} ratio {:.2f} seed {} lr {}: Test Loss: {:.4f}".format(
+                    run['snr'], run['ratio'], run['seed'], run['lr'], run['loss']))
+
+        if budget >= params['epochs']:
+            break
+        runs = [run for cell_runs in cells.values() for run in cell_runs[:max(1, len(cell_runs) // eta)]]
+        budget = min(budget * eta, params['epochs'])
+        rung += 1
+
+    best = [cell_runs[0] for cell_runs in cells.values()]
+    for run in best:
+        print_main("Best: snr {} ratio {:.2f} seed {} lr {} in {}".format(
+            run['snr'], run['ratio'], run['seed'], run['lr'], run['ckpt_dir']))
+    return best
+
+
+def train_pipeline_multi(params):
+    """
+    Train every (seed, ratio, snr) cell of the grid in one job.
+
+    Data is loaded once per batch for the whole grid. Models with the same
+    inner channel are stacked and run with vmap, each one keeps its own
+    channel, optimizer and scheduler, and writes logs, checkpoints and
+    configs as train_pipeline does. Runs on a single device.
+    """
+    dataset_name = params['dataset']
+    train_loader, test_loader = build_loaders(params)
+    image_fisrt = first_image(train_loader)
+    device = torch.device(params['device'] if torch.cuda.is_available() else 'cpu')
+    if params['compile']:
+        print("compile is not used in multi model mode")
+
+    runs = []
+    for seed in params['seed_list']:
+        set_seed(seed)
+        for ratio in params['ratio_list']:
+            for snr in params['snr_list']:
+                run_params = dict(params, ratio=ratio, snr=snr, seed=seed)
+                c = ratio2filtersize(image_fisrt, ratio)
+                print("The snr is {}, the inner channel is {}, the ratio is {:.2f}, the seed is {}".format(
+                    snr, c, ratio, seed))
+
+                # the default PReLU of the decoder layers is a single module shared
+                # by every DeepJSCC, the copy gives each model its own
+                model = copy.deepcopy(DeepJSCC(c=c, channel_type=params['channel'], snr=snr,
+                                               per_sample=params['per_sample_channel'])).to(device)
+                set_execution_mode(model, params['channels_last'])
+                optimizer = optim.Adam(
+                    model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
+
+                root_log_dir, root_ckpt_dir, root_config_dir = run_dirs(run_params, c)
+                writer = SummaryWriter(log_dir=root_log_dir)
+                writer.add_text('config', str(run_params))
+
+                runs.append({'params': run_params, 'c': c, 'model': model, 'optimizer': optimizer,
+                             'scheduler': build_scheduler(optimizer, run_params), 'writer': writer,
+                             'checkpoints': CheckpointWriter(root_ckpt_dir, params.get('keep_checkpoints', 2)),
+                             'config_dir': root_config_dir, 'epoch': 0, 'active': True})
+
+    t0 = time.time()
+    per_epoch_time = []
+
+    # train
+    # At any point you can hit Ctrl + C to break out of training early.
+    try:
+        with tqdm(range(params['epochs']), disable=params['disable_tqdm']) as t:
+            for epoch in t:
+
+                t.set_description('Epoch %d' % epoch)
+
+                start = time.time()
+
+                active = [run for run in runs if run['active']]
+                if len(active) == 0:
+                    break
+                groups = [[run for run in active if run['c'] == c] for c in sorted(set(run['c'] for run in active))]
+
+                train_losses = train_epoch_multi(
+                    [([run['model'] for run in group], [run['optimizer'] for run in group]) for group in groups],
+                    params, train_loader)
+                train_time = time.time() - start
+
+                val_start = time.time()
+                val_losses = evaluate_epoch_multi([[run['model'] for run in group] for group in groups],
+                                                  params, test_loader)
+                val_time = time.time() - val_start
+
+                for group, group_train_losses, group_val_losses in zip(groups, train_losses, val_losses):
+                    for run, epoch_train_loss, epoch_val_loss in zip(group, group_train_losses, group_val_losses):
+                        writer, optimizer, scheduler = run['writer'], run['optimizer'], run['scheduler']
+                        run['epoch'] = epoch
+
+                        writer.add_scalar('train/_loss', epoch_train_loss, epoch)
+                        writer.add_scalar('val/_loss', epoch_val_loss, epoch)
+                        writer.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
+                        # images per second of the whole grid
+                        writer.add_scalar('train/_throughput', len(train_loader.dataset) / train_time, epoch)
+                        writer.add_scalar('val/_throughput', len(test_loader.dataset) / val_time, epoch)
+
+                        if params['ReduceLROnPlateau'] and scheduler is not None:
+                            scheduler.step(epoch_val_loss)
+                        elif params['if_scheduler'] and not params['ReduceLROnPlateau']:
+                            scheduler.step()
+
+                        # Saving checkpoint
+                        run['checkpoints'].save(epoch, run['model'], optimizer, scheduler,
+                                                extra={'params': run['params']})
+
+                        if optimizer.param_groups[0]['lr'] < params['min_lr']:
+                            print("\n!! LR EQUAL TO MIN LR SET FOR SNR {} RATIO {:.2f}.".format(
+                                run['params']['snr'], run['params']['ratio']))
+                            run['active'] = False
+
+                t.set_postfix(time=time.time() - start, active=len(active),
+                              throughput=len(train_loader.dataset) / train_time)
+
+                per_epoch_time.append(time.time() - start)
+
                 # Stop training after params['max_time'] hours
                 if time.time() - t0 > params['max_time'] * 3600:
                     print('-' * 89)
@@ -334,34 +868,23 @@ def train_pipeline(params):
         print('-' * 89)
         print('Exiting from training early because of KeyboardInterrupt')
 
-    test_loss = evaluate_epoch(model, params, test_loader)
-    train_loss = evaluate_epoch(model, params, train_loader)
-    print("Test Accuracy: {:.4f}".format(test_loss))
-    print("Train Accuracy: {:.4f}".format(train_loss))
-    print("Convergence Time (Epochs): {:.4f}".format(epoch))
+    for run in runs:
+        run['checkpoints'].close()
+
+    groups = [[run for run in runs if run['c'] == c] for c in sorted(set(run['c'] for run in runs))]
+    test_losses = evaluate_epoch_multi([[run['model'] for run in group] for group in groups], params, test_loader)
+    train_losses = evaluate_epoch_multi([[run['model'] for run in group] for group in groups], params, train_loader)
     print("TOTAL TIME TAKEN: {:.4f}s".format(time.time() - t0))
     print("AVG TIME PER EPOCH: {:.4f}s".format(np.mean(per_epoch_time)))
 
-    """
-        Write the results in out_dir/results folder
-    """
+    for group, group_train_losses, group_test_losses in zip(groups, train_losses, test_losses):
+        for run, train_loss, test_loss in zip(group, group_train_losses, group_test_losses):
+            print("snr {} ratio {:.2f} seed {}: Test Accuracy: {:.4f} Train Accuracy: {:.4f}".format(
+                run['params']['snr'], run['params']['ratio'], run['params']['seed'], test_loss, train_loss))
+            write_results(run['writer'], run['params'], run['model'], run['c'], train_loss, test_loss,
+                          run['epoch'], t0, per_epoch_time, run['config_dir'])
 
-    writer.add_text(tag='result', text_string="""Dataset: {}\nparams={}\n\nTotal Parameters: {}\n\n
-    FINAL RESULTS\nTEST Loss: {:.4f}\nTRAIN Loss: {:.4f}\n\n
-    Convergence Time (Epochs): {:.4f}\nTotal Time Taken: {:.4f} hrs\nAverage Time Per Epoch: {:.4f} s\n\n\n"""
-                    .format(dataset_name, params, view_model_param(model), np.mean(np.array(train_loss)),
-                            np.mean(np.array(test_loss)), epoch, (time.time() - t0) / 3600, np.mean(per_epoch_time)))
-    writer.close()
-    if not os.path.exists(os.path.dirname(root_config_dir)):
-        os.makedirs(os.path.dirname(root_config_dir))
-    with open(root_config_dir + '.yaml', 'w') as f:
-        dict_yaml = {'dataset_name': dataset_name, 'params': params,
-                     'inner_channel': c, 'total_parameters': view_model_param(model)}
-        import yaml
-        yaml.dump(dict_yaml, f)
-
-    del model, optimizer, scheduler, train_loader, test_loader
-    del writer
+    del runs, train_loader, test_loader
 
 
 def train(args, ratio: float, snr: float):  # deprecated
@@ -1,4 +1,5 @@
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import os
 import numpy as np
@@ -57,3 +58,39 @@ def view_model_param(model):
         # print(param.data.size())
         total_param += np.prod(list(param.data.size()))
     return total_param
+
+
+def set_execution_mode(model, channels_last=False, compile=False):
+    """
+    Opt-in execution mode of a DeepJSCC or AlignedDeepJSCC, applied in place.
+
+    channels_last converts the weights, the convolutions then return
+    channels_last outputs whatever the layout of the input. compile compiles
+    encoder, decoder and aligner separately and leaves the channel in eager
+    mode, so change_channel and snr changes do not trigger a recompile and
+    the state_dict keys are unchanged.
+    """
+    module = model.module if isinstance(model, nn.DataParallel) else model
+
+    if channels_last:
+        module.to(memory_format=torch.channels_last)
+
+    if compile:
+        for name in ['encoder', 'decoder', 'aligner']:
+            submodule = getattr(module, name, None)
+            if submodule is not None:
+                submodule.compile()
+
+    return model
+
+
+def autocast(precision, device):
+    """
+    Autocast context of a precision param ('fp32' or 'bf16') on device.
+
+    fp32 returns a disabled context, so callers can always enter it.
+    """
+    if precision not in ['fp32', 'bf16']:
+        raise Exception('Unknown precision')
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=precision == 'bf16')